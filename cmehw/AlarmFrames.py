@@ -0,0 +1,83 @@
+# Alarm waveform frame decoding
+#
+# During an alarm capture the Avalanche firmware returns blocks of
+# 112-byte frames, each holding one sample of every STPM3X data
+# register (little-endian 32-bit words).  The frames of a capture are
+# collected into one buffer and decoded here in a single pass.
+
+import struct
+
+ALARM_FRAME_SIZE = 112
+
+# Frame layout (32-bit word index):
+#
+#	 0: CRC32                 1: ~CRC32
+#	 2: B1 V1DATA phA         3: B1 C1DATA phA
+#	 4: B1 V1DATA phB         5: B1 C1DATA phB
+#	 6: B1 CRMS/VRMS phA      7: B1 CRMS/VRMS phB
+#	 8: B1 status phA         9: B1 status phB
+#	10: B1 V1DATA phC        11: B1 C1DATA phC
+#	12: B1 CRMS/VRMS phC     13: B1 status phC
+#	14: B1 phase imbalance (unsigned, x1000)
+#	15: B2 V1DATA phA        16: B2 C1DATA phA
+#	17: B2 V1DATA phB        18: B2 C1DATA phB
+#	19: B2 CRMS/VRMS phA     20: B2 CRMS/VRMS phB
+#	21: B2 status phA        22: B2 status phB
+#	23: B2 V1DATA phC        24: B2 C1DATA phC
+#	25: B2 CRMS/VRMS phC     26: B2 status phC
+#	27: B2 phase imbalance (unsigned, x1000)
+#
+# V1DATA/C1DATA are full-width (32 bit) signed values, so the sign
+# extension is done by the struct format itself.
+ALARM_FRAME = struct.Struct('<2I12iI12iI')
+
+
+def decodeAlarmFrames(frames, scales):
+	''' Decodes a buffer of alarm frames into the alarm data structure
+		( { chId: { sId: [ samples ] } } ).  The scales are the
+		instantaneous scale factors of the SPI sensors in channel order.
+	'''
+	# trim any partial frame at the end of the buffer
+	frames = memoryview(frames)[:len(frames) - len(frames) % ALARM_FRAME_SIZE]
+
+	if not frames:
+		return {}
+
+	# one tuple per frame word across all frames
+	words = list(zip(*ALARM_FRAME.iter_unpack(frames)))
+
+	def scaled(index, scale):
+		return [ v * scale for v in words[index] ]
+
+	def imbalance(index):
+		return [ v / 1000 for v in words[index] ]
+
+	return {
+		"ch0": {
+			"s0": scaled(2, scales[0])
+		},
+		"ch1": {
+			"s0": scaled(4, scales[1])
+		},
+		"ch2": {
+			"s0": scaled(10, scales[2])
+		},
+		"ch3": {
+			"s0": imbalance(14)
+		},
+		"ch4": {
+			"s0": scaled(15, scales[3]),
+			"s1": scaled(16, scales[4])
+		},
+		"ch5": {
+			"s0": scaled(17, scales[5]),
+			"s1": scaled(18, scales[6])
+		},
+		"ch6": {
+			"s0": scaled(23, scales[7]),
+			"s1": scaled(24, scales[8])
+		},
+		"ch7": {
+			"s0": imbalance(27)
+		}
+	}
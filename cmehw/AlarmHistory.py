@@ -0,0 +1,91 @@
+# Bounded threshold alarm history
+#
+# The alarm history of a sensor threshold classification is a list of
+# points ([ time, value ] pairs) with None closing each alarm segment.
+# AlarmHistory keeps it in a deque, with the segment boundaries, so that
+# appends and tail reads don't depend on the history length, and evicts
+# the oldest closed segments once the history has more than max_points
+# points or max_segments segments, or its oldest segment ended more than
+# max_age_s before the newest point.  The open (last) segment is never
+# evicted.
+
+from collections import deque
+from itertools import islice
+
+
+class AlarmHistory():
+
+	__slots__ = ('_points', '_segments', 'max_points', 'max_segments', 'max_age_s', 'evicted')
+
+	def __init__(self, points=(), max_points=None, max_segments=None, max_age_s=None):
+		self._points = deque()
+
+		# [ point count, end time, closed ] of each segment, oldest first
+		self._segments = deque()
+
+		self.max_points = max_points
+		self.max_segments = max_segments
+		self.max_age_s = max_age_s
+
+		self.evicted = 0 # points evicted
+
+		self.extend(points)
+
+	def append(self, point):
+		self._points.append(point)
+
+		if not self._segments or self._segments[-1][2]:
+			self._segments.append([ 0, None, False ])
+
+		segment = self._segments[-1]
+		segment[0] += 1
+
+		if point is None:
+			segment[2] = True # closed
+		else:
+			segment[1] = point[0]
+
+		self._evict(segment[1])
+
+	def extend(self, points):
+		for p in points:
+			self.append(p)
+
+	def _evict(self, now):
+		segments = self._segments
+
+		while len(segments) > 1:
+			oldest = segments[0]
+
+			if not (self.max_points is not None and len(self._points) > self.max_points or
+					self.max_segments is not None and len(segments) > self.max_segments or
+					self.max_age_s is not None and now is not None and oldest[1] is not None and oldest[1] < now - self.max_age_s):
+				break
+
+			segments.popleft()
+			for i in range(oldest[0]):
+				self._points.popleft()
+
+			self.evicted += oldest[0]
+
+	def last(self):
+		''' The newest point (None if empty or the last segment is closed) '''
+		return self._points[-1] if self._points else None
+
+	def tail(self, n):
+		''' The newest n points, oldest first '''
+		points = list(islice(reversed(self._points), n))
+		points.reverse()
+		return points
+
+	def segments(self):
+		return len(self._segments)
+
+	def __len__(self):
+		return len(self._points)
+
+	def __iter__(self):
+		return iter(self._points)
+
+	def __repr__(self):
+		return "AlarmHistory({0} points, {1} segments)".format(len(self._points), len(self._segments))
@@ -0,0 +1,307 @@
+# Threshold alarm history persistence
+#
+# The threshold alarm history of a channel (see Thresholds.py) is kept on
+# disk as a snapshot plus an append-only journal:
+#
+#	chX_alarms.json		snapshot - { sId: { classification: [ point, ... ] } }
+#	chX_alarms.journal	changes since the snapshot, one JSON record per line
+#
+# Every point added to the history (a [ time, value ] pair, or None to
+# close an alarm segment) is appended to the journal as
+#
+#	[ "sId", "classification", point ]
+#
+# Appends are buffered and written every ALARMS_FLUSH_s (random within the
+# range, so channels don't all write at once).  Every ALARMS_COMPACT_s, or
+# when the journal reaches ALARMS_COMPACT_RECORDS, the whole history is
+# written as a new snapshot and the journal starts over.  Channels without
+# new points are never written.
+#
+# The first journal line identifies the snapshot it follows ({ "base":
+# [ size, mtime_ns ] } of the snapshot file).  If compaction was cut short
+# after the new snapshot was written, the journal's base doesn't match and
+# its records (already in the snapshot) aren't replayed.  readAlarms()
+# rebuilds the current history from the two files.
+#
+# The snapshot alone is NOT the current history: the points of up to
+# ALARMS_COMPACT_s (or ALARMS_COMPACT_RECORDS records) are only in the
+# journal.  Readers of the alarm history (e.g., the API layer) have to use
+# readAlarms(), or replay the journal the same way (see README.md).
+#
+# Saving can also be handed to the AlarmFlusher thread (when the main loop
+# is short of time).  The history is then written while the main loop keeps
+# adding points, so points (and new sensor or classification histories)
+# are added to the history and the journal under the journal lock (see
+# Thresholds._addPoints), and compaction writes a copy of the history taken
+# under the lock.  Saves queued before a reset are dropped (see generation).
+
+import os, json, time, logging, tempfile, threading, queue
+
+from random import randint
+
+from .common import Config
+from .common.LockedOpen import LockedOpen
+
+# The location where channel data and configuration are stored (typically /data/channels/)
+CHDIR = Config.PATHS.CHDIR
+
+ALARMS_FLUSH_s = (10, 20)
+ALARMS_COMPACT_s = 60
+ALARMS_COMPACT_RECORDS = 1000
+
+
+def _snapshotFile(ch_id, path):
+	return os.path.join(path, ch_id + '_alarms.json')
+
+def _journalFile(ch_id, path):
+	return os.path.join(path, ch_id + '_alarms.journal')
+
+def _snapshotBase(snapshot_file):
+	# identifies the snapshot file version a journal follows
+	try:
+		st = os.stat(snapshot_file)
+		return [ st.st_size, st.st_mtime_ns ]
+	except OSError:
+		return None
+
+
+def _replay(alarms, journal_file, base):
+	''' Adds the journal records to alarms (if the journal follows the
+		snapshot identified by base).  Returns the number of records.
+	'''
+	try:
+		with open(journal_file, 'r') as f:
+			lines = f.readlines()
+	except OSError:
+		return 0
+
+	if not lines:
+		return 0
+
+	try:
+		header = json.loads(lines[0])
+	except ValueError:
+		header = {}
+
+	if header.get('base') != base:
+		return 0 # compacted into the snapshot already
+
+	count = 0
+	for line in lines[1:]:
+		try:
+			sId, classification, point = json.loads(line)
+		except ValueError:
+			continue # torn write (power loss)
+
+		alarms.setdefault(sId, {}).setdefault(classification, []).append(point)
+		count += 1
+
+	return count
+
+
+def readAlarms(ch_id, path=CHDIR):
+	''' Returns the channel's current threshold alarm history
+		{ sId: { classification: [ point, ... ] } } from the snapshot
+		and the journal.
+	'''
+	snapshot_file = _snapshotFile(ch_id, path)
+
+	alarms = {}
+	if os.path.isfile(snapshot_file):
+		with open(snapshot_file, 'r') as f:
+			alarms = json.load(f)
+
+	_replay(alarms, _journalFile(ch_id, path), _snapshotBase(snapshot_file))
+	return alarms
+
+
+
+class AlarmJournal():
+	''' Writes the threshold alarm history changes of one channel '''
+
+	def __init__(self, ch_id, path=CHDIR):
+		self._logger = logging.getLogger(__name__)
+
+		self.ch_id = ch_id
+		self.snapshot_file = _snapshotFile(ch_id, path)
+		self.journal_file = _journalFile(ch_id, path)
+
+		self._pending = [] # records not written yet
+		self._records = 0 # records in the journal file
+		self.dirty = False # changes not in the snapshot yet
+
+		# held while changing the pending records (and the history)
+		self.lock = threading.RLock()
+
+		# held while saving (on the main loop or the flusher thread)
+		self._saving = threading.Lock()
+
+		# counts the resets, so saves of the history from before
+		# a reset (queued on the flusher) are dropped
+		self.generation = 0
+
+		now = time.time()
+		self._flush_time = now + randint(*ALARMS_FLUSH_s)
+		self._compact_time = now + ALARMS_COMPACT_s
+
+	def load(self):
+		''' Returns the alarm history from disk (see readAlarms) '''
+		alarms = {}
+		if os.path.isfile(self.snapshot_file):
+			with open(self.snapshot_file, 'r') as f:
+				alarms = json.load(f)
+
+		self._records = _replay(alarms, self.journal_file, _snapshotBase(self.snapshot_file))
+		self.dirty = self._records > 0
+		return alarms
+
+	def reset(self):
+		''' Removes the channel's alarm history files '''
+		with self._saving, self.lock:
+			for f in [ self.snapshot_file, self.journal_file ]:
+				if os.path.isfile(f):
+					os.remove(f)
+
+			self._pending = []
+			self._records = 0
+			self.dirty = False
+			self.generation += 1
+
+	def append(self, sId, classification, point):
+		with self.lock:
+			self._pending.append([ sId, classification, point ])
+			self.dirty = True
+
+	def save(self, alarms, force=False, blocking=True, generation=None):
+		''' Writes the pending records and compacts alarms (the channel's
+			full history) into a new snapshot when due (or if forced).
+			Returns False (without saving) if not blocking and the journal
+			is being saved on another thread.  Alarms from before a reset
+			(generation isn't the journal's) aren't saved.
+		'''
+		if not self._saving.acquire(blocking):
+			return False
+
+		try:
+			if generation is not None and generation != self.generation:
+				return True # reset since
+			now = time.time()
+
+			if self.dirty and (force or now >= self._compact_time or self._records + len(self._pending) >= ALARMS_COMPACT_RECORDS):
+				self.compact(alarms)
+
+			elif self._pending and now >= self._flush_time:
+				self._writePending()
+
+			if now >= self._flush_time:
+				self._flush_time = now + randint(*ALARMS_FLUSH_s)
+
+		finally:
+			self._saving.release()
+
+		return True
+
+	def _writePending(self):
+		with self.lock:
+			records = self._pending
+			self._pending = []
+
+		with open(self.journal_file, 'a') as f:
+			if f.tell() == 0:
+				f.write(json.dumps({ 'base': _snapshotBase(self.snapshot_file) }) + '\n')
+
+			f.write(''.join([ json.dumps(r, separators=(',', ':')) + '\n' for r in records ]))
+
+		self._records += len(records)
+
+	def compact(self, alarms):
+		''' Writes alarms as the new snapshot and starts a new journal '''
+		start_time = time.time()
+
+		# the points added from here on go in the new journal
+		with self.lock:
+			alarms = { sId: { classification: list(points) for classification, points in s_alarms.items() }
+				for sId, s_alarms in alarms.items() }
+			compacted = len(self._pending)
+
+		with LockedOpen(self.snapshot_file, 'a'):
+			with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.snapshot_file), delete=False) as tf:
+				json.dump(alarms, tf, separators=(',', ':'))
+				tempname = tf.name
+			os.replace(tempname, self.snapshot_file)
+
+		# the new (empty) journal follows the new snapshot
+		with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.journal_file), delete=False) as tf:
+			tf.write(json.dumps({ 'base': _snapshotBase(self.snapshot_file) }) + '\n')
+			tempname = tf.name
+		os.replace(tempname, self.journal_file)
+
+		with self.lock:
+			del self._pending[:compacted]
+			self._records = 0
+			self.dirty = len(self._pending) > 0
+
+		self._compact_time = time.time() + ALARMS_COMPACT_s
+
+		self._logger.debug("{0} alarms compacted in {1:.3f} s".format(self.ch_id, time.time() - start_time))
+
+
+
+class AlarmFlusher(threading.Thread):
+	''' Saves the alarm journals handed off from the main loop '''
+
+	def __init__(self):
+		super(AlarmFlusher, self).__init__(name='AlarmFlusher', daemon=True)
+
+		self._logger = logging.getLogger(__name__)
+		self._queue = queue.Queue()
+		self._queued = set() # ids of the channels queued
+
+		self.saves = 0
+		self.errors = 0
+		self.last_save_s = 0
+		self.max_save_s = 0
+
+	def submit(self, journal, alarms):
+		''' Queues the journal save (once - until saved) '''
+		if journal.ch_id in self._queued:
+			return
+
+		self._queued.add(journal.ch_id)
+		self._queue.put((journal, alarms, journal.generation))
+
+	def stats(self):
+		return {
+			'saves': self.saves,
+			'errors': self.errors,
+			'last_save_s': self.last_save_s,
+			'max_save_s': self.max_save_s,
+			'queue_depth': self._queue.qsize()
+		}
+
+	def run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break # closed
+
+			journal, alarms, generation = item
+			self._queued.discard(journal.ch_id)
+
+			start_time = time.time()
+
+			try:
+				journal.save(alarms, generation=generation)
+				self.saves += 1
+
+			except Exception as e:
+				self.errors += 1
+				self._logger.error("{0} alarms save failed: {1}".format(journal.ch_id, e))
+
+			self.last_save_s = time.time() - start_time
+			self.max_save_s = max(self.max_save_s, self.last_save_s)
+
+	def close(self):
+		''' Saves the queued journals and stops '''
+		self._queue.put(None)
+		self.join()
@@ -1,13 +1,36 @@
-import os, json, time, threading
+import os, json, time, threading, logging, queue
 
 import sqlite3
 
+from collections.abc import Mapping
+
 
 from .common import Config
 
+from .Waveforms import packWaveform, unpackWaveform
+
 # Alarms database
 ALARMS = Config.PATHS.ALARMS_DB
 
+# zlib-compress the waveform blobs
+WAVEFORM_COMPRESS = True
+
+# Connection settings - WAL journaling lets the API layer read while
+# alarms are written, and synchronous NORMAL is safe with WAL (a power
+# loss can only lose the last transactions, not corrupt the database).
+ALARMS_PRAGMAS = [
+	'journal_mode = WAL',
+	'synchronous = NORMAL',
+	'cache_size = -4096', # KiB
+	'mmap_size = 67108864',
+	'temp_store = MEMORY'
+]
+
+# Alarm writer batching - up to MAX alarms queued within WAIT seconds
+# of each other are written in one transaction
+ALARMS_BATCH_MAX = 32
+ALARMS_BATCH_WAIT_s = 0.05
+
 
 
 class Singleton(type):
@@ -19,68 +42,142 @@ class Singleton(type):
 
 
 
-class LockableCursor:
-	def __init__(self, cursor):
-		self.cursor = cursor
-		self.lock = threading.Lock()
+def _dictFactory(cursor, row):
+	aDict = {}
+	for iField, field, in enumerate(cursor.description):
+		aDict[field[0]] = row[iField]
+	return aDict
 
-	def execute(self, arg0, arg1=None):
-		self.lock.acquire()
 
-		try:
-			#print("{}".format(arg1 if arg1 else arg0))
-			
-			if arg1:
-				result = []
+def _connect(path, readonly=False):
+	''' Opens an alarms database connection with the ALARMS_PRAGMAS applied
+	'''
+	# reader connections are closed by AlarmManager.Close (on any thread)
+	connection = sqlite3.connect(path, check_same_thread=not readonly)
+	connection.row_factory = _dictFactory
+	connection.text_factory = str
 
-			self.cursor.execute(arg1 if arg1 else arg0)
+	for pragma in ALARMS_PRAGMAS:
+		connection.execute('PRAGMA ' + pragma)
 
-			if arg1:
-				if arg0 == 'all':
-					result = self.cursor.fetchall()
-				elif arg0 == 'one':
-					result = self.cursor.fetchone()
+	if readonly:
+		connection.execute('PRAGMA query_only = ON')
 
-		except Exception as e:
-			raise e
+	return connection
+
+
+def _insertAlarm(connection, Alarm_object):
+	''' Inserts an alarm (in the caller's transaction) and sets its id
+	'''
+	# The alarm row holds the alarm metadata, and the waveform
+	# data go to the alarm_waveforms table as packed blobs.
+	alarm_id = connection.execute('INSERT INTO alarms(channel, sensor, type, start_ms, end_ms, step_ms, data) VALUES(?, ?, ?, ?, ?, ?, NULL)', \
+		(Alarm_object.channel, Alarm_object.sensor, Alarm_object.type, Alarm_object.start_ms, Alarm_object.end_ms, Alarm_object.step_ms)).lastrowid
+
+	waveforms = []
+	for ch, sensors in (Alarm_object.data or {}).items():
+		for s, samples in sensors.items():
+			waveforms.append( (alarm_id, ch, s, packWaveform(samples, Alarm_object.step_ms, compress=WAVEFORM_COMPRESS)) )
 
-		finally:
-			self.lock.release()
-			if arg1:
-				return result
+	connection.executemany('INSERT INTO alarm_waveforms(alarm_id, channel, sensor, waveform) VALUES(?, ?, ?, ?)', waveforms)
 
-	def executemany(self, arg0, arg1):
-		self.lock.acquire()
+	Alarm_object.id = alarm_id
 
+
+
+class _AlarmWriter(threading.Thread):
+	''' Writes queued alarms to the database on its own connection.  Alarms
+		queued close together are written in a single transaction.
+	'''
+	def __init__(self, path):
+		super(_AlarmWriter, self).__init__(name='AlarmWriter', daemon=True)
+
+		self._logger = logging.getLogger(__name__)
+		self._path = path
+		self._queue = queue.Queue()
+
+		self.batches = 0
+		self.inserted = 0
+		self.errors = 0
+
+	def submit(self, Alarm_object):
+		self._queue.put(Alarm_object)
+
+	def flush(self):
+		self._queue.join()
+
+	def stop(self):
+		self._queue.put(None)
+		self.join()
+
+	def _store(self, connection, alarms):
 		try:
-			self.cursor.executemany(arg0, arg1)
+			with connection: # one transaction (commit or rollback)
+				for a in alarms:
+					_insertAlarm(connection, a)
+
+			self.batches += 1
+			self.inserted += len(alarms)
+			return
 
 		except Exception as e:
-			raise e
+			if len(alarms) == 1:
+				self.errors += 1
+				self._logger.error("Failed to store alarm: {0}".format(e))
+				return
+
+		# store the alarms one by one so a bad alarm doesn't lose the others
+		for a in alarms:
+			self._store(connection, [ a ])
+
+	def run(self):
+		connection = _connect(self._path)
+		stop = False
+
+		while not stop:
+			# wait for an alarm, then gather whatever else
+			# arrives within the batch wait time
+			batch = [ self._queue.get() ]
+			deadline = time.time() + ALARMS_BATCH_WAIT_s
 
-		finally:
-			self.lock.release()
+			while len(batch) < ALARMS_BATCH_MAX:
+				try:
+					batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+				except queue.Empty:
+					break
+
+			stop = None in batch
+			alarms = [ a for a in batch if a is not None ]
+
+			try:
+				self._store(connection, alarms)
+
+			finally:
+				for a in batch:
+					self._queue.task_done()
+
+		connection.close()
 
 
 
 class AlarmManager(metaclass=Singleton):
 
-	_connection = None
-	_cursor = None
+	_writer = None
+	_closed = False
 
-	def __init__(self):
+	def __init__(self, path=ALARMS):
 
-		def dictFactory(cursor, row):
-			aDict = {}
-			for iField, field, in enumerate(cursor.description):
-				aDict[field[0]] = row[iField]
-			return aDict
+		if not self._writer:
+			self._path = path
 
-		if not self._connection:
-			self._connection = sqlite3.connect(ALARMS, check_same_thread = False)
-			self._connection.row_factory = dictFactory
-			self._connection.text_factory = str
-			self._cursor = LockableCursor(self._connection.cursor())
+			# reader connections are opened per thread (see _query) so
+			# readers never wait on the writer connection (WAL mode) -
+			# all of them are kept in _connections to be closed by Close
+			self._readers = threading.local()
+			self._connections = []
+			self._connectionsLock = threading.Lock()
+
+			connection = _connect(path)
 
 			# Create the alarms table if it's not already there
 			# Use columns:
@@ -90,18 +187,91 @@ class AlarmManager(metaclass=Singleton):
 			#	source_sensor (TEXT) - sensor id of the alarm trigger source (e.g., 's0')
 			#	type (TEXT) - classification string for the type of alarm (e.g., 'SAG')
 			#	data (TEXT) - waveform data in JSON object string that can be stored with the alarm
-			self._cursor.execute('''CREATE TABLE IF NOT EXISTS alarms 
+			#		(older alarms only - newer alarms store waveforms in the alarm_waveforms table)
+			connection.execute('''CREATE TABLE IF NOT EXISTS alarms 
 				(id INTEGER PRIMARY KEY, channel TEXT, sensor TEXT, type TEXT, start_ms INT, end_ms INT, step_ms INT, data TEXT)''')
 
+			# Alarm waveforms - one row per channel sensor waveform of an alarm
+			# Use columns:
+			#	alarm_id (INT) - id of the alarm in the alarms table
+			#	channel (TEXT) - channel id of the waveform (e.g., 'ch0')
+			#	sensor (TEXT) - sensor id of the waveform (e.g., 's0')
+			#	waveform (BLOB) - packed waveform samples (see Waveforms.py)
+			connection.execute('''CREATE TABLE IF NOT EXISTS alarm_waveforms
+				(alarm_id INTEGER, channel TEXT, sensor TEXT, waveform BLOB, PRIMARY KEY (alarm_id, channel, sensor))''')
+
+			# Indexes for the alarm queries (see QueryAlarms) - all end
+			# in (start_ms, id) to match the newest-first page ordering
+			connection.execute('CREATE INDEX IF NOT EXISTS alarms_start ON alarms (start_ms, id)')
+			connection.execute('CREATE INDEX IF NOT EXISTS alarms_channel_start ON alarms (channel, start_ms, id)')
+			connection.execute('CREATE INDEX IF NOT EXISTS alarms_type_start ON alarms (type, start_ms, id)')
+
+			connection.commit()
+			connection.close()
+
+			# alarms are written by the writer thread
+			self._writer = _AlarmWriter(path)
+			self._writer.start()
+
 
 	def __del__(self):
 
-		self._connection.close()
+		self.Close()
 
 
-	def InsertAlarm(self, Alarm_object):
+	def Close(self):
+		''' Writes any queued alarms, stops the writer thread and closes
+			the reader connections.  The AlarmManager can't be used after.
+		'''
+		if not self._writer or self._closed:
+			return
+
+		if self._writer.is_alive():
+			self._writer.stop()
+
+		with self._connectionsLock:
+			self._closed = True
+			connections = self._connections
+			self._connections = []
 
-		alarms = []
+		for connection in connections:
+			connection.close()
+
+
+	def _checkOpen(self):
+		if self._closed:
+			raise sqlite3.ProgrammingError("Cannot operate on a closed AlarmManager")
+
+
+	def Flush(self):
+		''' Waits until all queued alarms are written
+		'''
+		self._writer.flush()
+
+
+	def _query(self, fetch, sql, params=()):
+		''' Runs a query on this thread's reader connection and returns
+			'all' rows or 'one' row.
+		'''
+		self._checkOpen()
+
+		connection = getattr(self._readers, 'connection', None)
+
+		if not connection:
+			with self._connectionsLock:
+				self._checkOpen()
+				connection = _connect(self._path, readonly=True)
+				self._connections.append(connection)
+			self._readers.connection = connection
+
+		cursor = connection.execute(sql, params)
+		return cursor.fetchall() if fetch == 'all' else cursor.fetchone()
+
+
+	def InsertAlarm(self, Alarm_object):
+		''' Queues the alarm for the writer thread.  The alarm id is set
+			once the alarm has been written (see Flush).
+		'''
 
 		# for c in range(0, count):
 
@@ -204,14 +374,140 @@ class AlarmManager(metaclass=Singleton):
 			# # Make the alarm a tuple of the fields
 			# alarms.append( (a['channel'], a['sensor'], a['type'], a['start_ms'], a['end_ms'], a['step_ms'], json.dumps(a['data'])) )
 
-		alarms.append( (Alarm_object.channel, Alarm_object.sensor, Alarm_object.type, Alarm_object.start_ms, Alarm_object.end_ms,  \
-			Alarm_object.step_ms, json.dumps(Alarm_object.data)) )
-
-		self._cursor.executemany('INSERT INTO alarms(channel, sensor, type, start_ms, end_ms, step_ms, data) VALUES(?, ?, ?, ?, ?, ?, ?)', alarms)
-		self._connection.commit()
+		self._checkOpen()
+		self._writer.submit(Alarm_object)
 		return 0
 
 
+	def GetAlarm(self, alarm_id):
+		''' Returns the Alarm with the given id (or None) including its waveform data
+		'''
+		alarm = self._query('one', 'SELECT * FROM alarms WHERE id = ?', (alarm_id, ))
+
+		if not alarm:
+			return None
+
+		waveforms = self._query('all', 'SELECT channel, sensor, waveform FROM alarm_waveforms WHERE alarm_id = ?', (alarm_id, ))
+
+		return Alarm(alarm, waveforms)
+
+
+	def ListAlarms(self, limit=None, offset=0):
+		''' Returns Alarms (newest first) with metadata only.  Waveform data
+			is loaded from the database if an alarm's data is accessed.
+		'''
+		return self.QueryAlarms(limit=limit, offset=offset)
+
+
+	def QueryAlarms(self, start_ms=None, end_ms=None, channel=None, sensor=None, alarm_type=None,
+		limit=100, offset=0, before=None, with_data=False):
+		''' Returns a page of Alarms, newest first, filtered by alarm start time
+			range (inclusive), channel, sensor and type.
+
+			Pages can be walked with limit/offset, or (faster for deep pages)
+			with the keyset cursor 'before' set to the (start_ms, id) of the
+			last alarm of the previous page.
+
+			Alarms are returned with metadata only unless with_data is set;
+			otherwise waveform data is loaded on access.
+		'''
+		where = []
+		params = []
+
+		if start_ms is not None:
+			where.append('start_ms >= ?')
+			params.append(start_ms)
+
+		if end_ms is not None:
+			where.append('start_ms <= ?')
+			params.append(end_ms)
+
+		if channel is not None:
+			where.append('channel = ?')
+			params.append(channel)
+
+		if sensor is not None:
+			where.append('sensor = ?')
+			params.append(sensor)
+
+		if alarm_type is not None:
+			where.append('type = ?')
+			params.append(alarm_type)
+
+		if before is not None:
+			where.append('(start_ms, id) < (?, ?)')
+			params.extend([ before[0], before[1] ])
+
+		sql = 'SELECT id, channel, sensor, type, start_ms, end_ms, step_ms FROM alarms'
+		if where:
+			sql += ' WHERE ' + ' AND '.join(where)
+		sql += ' ORDER BY start_ms DESC, id DESC LIMIT ? OFFSET ?'
+		params.extend([ -1 if limit is None else limit, offset ])
+
+		alarms = self._query('all', sql, tuple(params))
+
+		if not with_data:
+			return [ Alarm(a, self._waveformLoader(a['id'])) for a in alarms ]
+
+		# load the waveforms of the whole page at once
+		ids = [ a['id'] for a in alarms ]
+		waveforms = {}
+		if ids:
+			rows = self._query('all', 'SELECT alarm_id, channel, sensor, waveform FROM alarm_waveforms WHERE alarm_id IN ({0})'.format(
+				','.join('?' * len(ids))), tuple(ids))
+			for w in rows:
+				waveforms.setdefault(w['alarm_id'], []).append(w)
+
+		# older alarms without waveform rows still load their JSON data on access
+		return [ Alarm(a, waveforms[a['id']] if a['id'] in waveforms else self._waveformLoader(a['id'])) for a in alarms ]
+
+
+	def _waveformLoader(self, alarm_id):
+		''' Returns a function that loads an alarm's data on first access.
+			Channel waveforms are loaded one channel at a time.
+		'''
+		def load():
+			channels = self._query('all', 'SELECT channel FROM alarm_waveforms WHERE alarm_id = ?', (alarm_id, ))
+
+			if not channels:
+				# older alarms have the waveforms as JSON in the data column
+				alarm = self._query('one', 'SELECT data FROM alarms WHERE id = ?', (alarm_id, ))
+				return json.loads(alarm['data']) if alarm and alarm['data'] else {}
+
+			def load_channel(channel):
+				return self._query('all', 'SELECT channel, sensor, waveform FROM alarm_waveforms WHERE alarm_id = ? AND channel = ?', (alarm_id, channel))
+
+			return _AlarmWaveforms([ c['channel'] for c in channels ], load_channel)
+
+		return load
+
+
+
+class _AlarmWaveforms(Mapping):
+	''' Alarm waveform data by channel ( { chId: { sId: [ samples ] } } ).
+		The waveform blobs of a channel are decoded on first access.
+	'''
+	def __init__(self, channels, load_channel):
+		self._channels = list(dict.fromkeys(channels)) # unique, in order
+		self._load_channel = load_channel # channel -> waveform rows
+		self._decoded = {}
+
+	def __getitem__(self, channel):
+		if not channel in self._decoded:
+			if not channel in self._channels:
+				raise KeyError(channel)
+
+			self._decoded[channel] = { w['sensor']: unpackWaveform(w['waveform'])[1] for w in self._load_channel(channel) }
+
+		return self._decoded[channel]
+
+	def __iter__(self):
+		return iter(self._channels)
+
+	def __len__(self):
+		return len(self._channels)
+
+
 
 
 class Alarm():
@@ -258,7 +554,7 @@ class Alarm():
 
 
 
-	def __init__(self, alarm=None):
+	def __init__(self, alarm=None, waveforms=None):
 
 		if not alarm:
 			self.id = 1
@@ -278,8 +574,47 @@ class Alarm():
 			self.start_ms = alarm['start_ms']
 			self.end_ms = alarm['end_ms']
 			self.step_ms = alarm['step_ms']
-			self.data = json.loads(alarm['data'])
+
+			# The waveform data payload is held as-is and only decoded when
+			# the data is accessed.  It's either the JSON text of older alarms,
+			# the waveform rows or a function that loads them (see ListAlarms).
+			self._data = None
+			self._payload = alarm.get('data') or waveforms
+
+	@property
+	def data(self):
+		if self._data is None and self._payload is not None:
+			payload = self._payload
+
+			if isinstance(payload, str):
+				self._data = json.loads(payload)
+
+			elif callable(payload):
+				self._data = payload()
+
+			else:
+				# waveform rows - group the blobs by channel
+				rows = {}
+				for w in payload:
+					rows.setdefault(w['channel'], []).append(w)
+
+				self._data = _AlarmWaveforms(rows.keys(), rows.get)
+
+			self._payload = None
+
+		return self._data
+
+	@data.setter
+	def data(self, value):
+		self._data = value
+		self._payload = None
 
 	def __repr__(self):
-		return "Alarm[{}]:({}, {}, {}, {}, {}, {}, data[{}])".format(self.id, self.channel, self.sensor, self.type, self.start_ms, self.end_ms, self.step_ms, len(self.data['ch0']['s0']) if self.data else 0)
+		# don't load the data just to show it
+		if self._payload is not None:
+			samples = '...'
+		else:
+			samples = len(self._data['ch0']['s0']) if self._data and 'ch0' in self._data else 0
+
+		return "Alarm[{}]:({}, {}, {}, {}, {}, {}, data[{}])".format(self.id, self.channel, self.sensor, self.type, self.start_ms, self.end_ms, self.step_ms, samples)
 
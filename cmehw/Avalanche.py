@@ -1,6 +1,4 @@
-import os, logging, time, glob, json
-
-from collections import deque
+import os, logging, time, glob, json, threading, queue, math
 
 
 import RPi.GPIO as GPIO
@@ -11,6 +9,10 @@ from .common import Config
 # load the STPM3X module and import Stpm3x class
 from .STPM3X import Stpm3x
 from .Alarms import Alarm
+from .AlarmFrames import ALARM_FRAME_SIZE, decodeAlarmFrames
+from .SampleBuffer import SampleBuffer
+from .Virtual import VirtualFormulas, evaluationOrder
+from .BusReaders import BusReaders
 
 # GPIO assignments
 #AVALANCHE_GPIO_SENSOR_POWER     = 5
@@ -50,11 +52,31 @@ AVALANCHE_GPIO_DATA_RDY 		= 25
 # Discharge sensors for this long before enabling SPI bus
 SPI_BUS_DISCHARGE_WAIT_s = 10
 
+# How to wait for the DATA_RDY line during alarm capture: 'EDGE' waits
+# on a GPIO edge detect event, 'POLL' polls the line with exponential
+# backoff between the MIN and MAX poll intervals.  'EDGE' falls back
+# to 'POLL' if edge detection can't be set up on the pin.
+DATA_RDY_WAIT_MODE = 'EDGE'
+DATA_RDY_TIMEOUT_s = 0.5
+DATA_RDY_POLL_MIN_s = 0.00005
+DATA_RDY_POLL_MAX_s = 0.002
+
+# Width of the STPM3X sync (SYN) pulse
+SYNC_PULSE_s = 0.001
+
+# Read the channels of each SPI bus on its own thread (if there's more
+# than one bus in use, see BusReaders.py)
+SPI_PARALLEL_BUSES = True
+
 # Hardware channels configurations stored here
 CHDIR = Config.PATHS.CHDIR
 
 BUFFER_POINTS = Config.HARDWARE.BUFFER_POINTS
 
+# Channels and sensors are read every loop unless they have a lower
+# "sample_rate_hz" set in their _config (see _buildTimetable)
+LOOP_PERIOD_s = Config.HARDWARE.LOOP_PERIOD_s
+
 # configure SPI bus
 #spi = spidev.SpiDev()
 #spi.open(0, 0)
@@ -63,23 +85,30 @@ BUFFER_POINTS = Config.HARDWARE.BUFFER_POINTS
 
 
 class _Sensor:
-	def __init__(self, id, sensor_type, unit, sensor_range, read_function):
+
+	__slots__ = ('id', 'type', 'unit', 'range', 'sample_rate_hz', '_read', 'values')
+
+	def __init__(self, id, sensor_type, unit, sensor_range, read_function, sample_rate_hz=None):
 		self.id = id
 		self.type = sensor_type
 		self.unit = unit
 		self.range = sensor_range
+		self.sample_rate_hz = sample_rate_hz # None: channel rate
 		self._read = read_function
 
 		# keep a buffer of values
-		# new values are pushed at left (values[0])
-		# and oldest value falls off right
-		self.values = deque([None for x in range(BUFFER_POINTS)]) 
+		# new values are pushed at values[0]
+		# and the oldest value falls off
+		self.values = SampleBuffer(BUFFER_POINTS)
 
 	def read(self, tick):
 
 		value = self._read() # read the sensor value
-		self.values.appendleft([ tick, value ]) # push onto buffer
-		self.values.pop() # remove oldest
+		return self.push(tick, value)
+
+	def push(self, tick, value):
+
+		self.values.push(tick, value)
 		return value
 
 	def __repr__(self):
@@ -88,7 +117,10 @@ class _Sensor:
 
 
 class _Channel:
-	def __init__(self, id, bus_type, bus_index, bus_device_index, rra, error, sensors):
+
+	__slots__ = ('id', 'bus_type', 'bus_index', 'bus_device_index', 'rra', 'stale', 'error', 'sensors', 'sample_rate_hz', '_read')
+
+	def __init__(self, id, bus_type, bus_index, bus_device_index, rra, error, sensors, read_function=None, sample_rate_hz=None):
 		self.id = id
 		self.bus_type = bus_type
 		self.bus_index = bus_index
@@ -97,6 +129,22 @@ class _Channel:
 		self.stale = False
 		self.error = error
 		self.sensors = sensors
+		self.sample_rate_hz = sample_rate_hz # None: every loop
+		self._read = read_function
+
+	def read(self, tick, sIds=None):
+		''' Reads the sensors (or only those with sIds) '''
+
+		# channels with a batch read function get all their
+		# sensor values from a single device transaction
+		if self._read:
+			for sId, value in self._read(tick, sIds).items():
+				self.sensors[sId].values.push(tick, value)
+			return
+
+		for s in self.sensors.values():
+			if sIds is None or s.id in sIds:
+				s.read(tick)
 
 	def __repr__(self):
 		s = "Channel {0} has {1} sensors".format(self.id, len(self.sensors))
@@ -107,12 +155,23 @@ class _Channel:
 
 
 class _VirtualChannel:
-	def __init__(self, id, rra, error, sensors):
+
+	__slots__ = ('id', 'rra', 'stale', 'error', 'sensors', 'formulas', 'sample_rate_hz')
+
+	def __init__(self, id, rra, error, sensors, formulas, sample_rate_hz=None):
 		self.id = id
 		self.rra = rra
 		self.stale = False
 		self.error = error
 		self.sensors = sensors
+		self.formulas = formulas # VirtualFormulas
+		self.sample_rate_hz = sample_rate_hz # None: every loop
+
+	def read(self, tick, sIds=None):
+
+		# all sensor formulas are evaluated in one pass over the sources
+		for sId, value in self.formulas.evaluate(sIds).items():
+			self.sensors[sId].values.push(tick, value)
 
 	def __repr__(self):
 		s = "VirtualChannel {0} has {1} sensors".format(self.id, len(self.sensors))
@@ -122,31 +181,71 @@ class _VirtualChannel:
 
 
 
+class _AlarmCaptureWorker(threading.Thread):
+	'''
+	Runs alarm waveform captures handed off from the main loop.  Capture
+	requests are queued, so back-to-back alarms are captured in order.
+	'''
+	def __init__(self, capture_function):
+		super(_AlarmCaptureWorker, self).__init__(name='AlarmCapture', daemon=True)
+
+		self._logger = logging.getLogger(__name__)
+		self._capture = capture_function
+		self._queue = queue.Queue()
+
+		self.captures = 0
+		self.errors = 0
+		self.last_capture_s = 0
+		self.max_capture_s = 0
+		self.last_capture_cpu_s = 0
+
+	def submit(self, start_ms, end_ms):
+		self._queue.put((start_ms, end_ms))
+		self._logger.info("Alarm capture queued (queue depth: {0})".format(self._queue.qsize()))
+
+	def stats(self):
+		return {
+			'captures': self.captures,
+			'errors': self.errors,
+			'last_capture_s': self.last_capture_s,
+			'max_capture_s': self.max_capture_s,
+			'last_capture_cpu_s': self.last_capture_cpu_s,
+			'queue_depth': self._queue.qsize()
+		}
+
+	def run(self):
+		while True:
+			start_ms, end_ms = self._queue.get()
+
+			start_time = time.time()
+			start_cpu = time.thread_time() # CPU time used by this thread only
+
+			try:
+				self._capture(start_ms, end_ms)
+				self.captures += 1
+
+			except Exception as e:
+				self.errors += 1
+				self._logger.error("Alarm capture failed: {0}".format(e))
+
+			self.last_capture_s = time.time() - start_time
+			self.last_capture_cpu_s = time.thread_time() - start_cpu
+			self.max_capture_s = max(self.max_capture_s, self.last_capture_s)
+
+			self._logger.info("Alarm capture took {0:.3f} s, {1:.3f} s CPU (queue depth: {2})".format(
+				self.last_capture_s, self.last_capture_cpu_s, self._queue.qsize()))
+
+
+
 class Avalanche(object):
 
 	Channels = {} # dict of _Channel
 
+	Devices = {} # dict of Stpm3x by (bus_index, device_index)
+
 	alarmData = []
 	alarmManager = []
 
-	b1_voltage_pha = []
-	b1_current_pha = [] 
-	b1_voltage_phb = []
-	b1_current_phb = []
-	b1_voltage_phc = []
-	b1_current_phc = []
-	b1_status_pha = []
-	b1_status_phb = []
-	b1_ph_imbalance = []
-	b2_voltage_pha = []
-	b2_current_pha = [] 
-	b2_voltage_phb = []
-	b2_current_phb = []
-	b2_voltage_phc = []
-	b2_current_phc = []
-	b1_status_phc = []
-	b2_ph_imbalance = []
-
 	alarm_state = False
 	alarm_start_time = 0
 	alarm_stop_time  = 0
@@ -154,6 +253,9 @@ class Avalanche(object):
 	def alarm_end(self, arg1):
 		self.alarm_stop_time = time.time() * 1000
 
+	def data_ready(self, arg1):
+		self._dataReady.set()
+
 	def alarm(self, arg1):
 	#self._logger.info("\n\nAlarm Occurred"))
 		if GPIO.input(AVALANCHE_GPIO_ALARM) == GPIO.HIGH:
@@ -161,24 +263,6 @@ class Avalanche(object):
 
 			print("\nAlarm Start: ", self.alarm_start_time)
 
-			self.b1_voltage_pha = []
-			self.b1_current_pha = [] 
-			self.b1_voltage_phb = []
-			self.b1_current_phb = []
-			self.b1_voltage_phc = []
-			self.b1_current_phc = []
-			self.b1_status_pha = []
-			self.b1_status_phb = []
-			self.b1_ph_imbalance = []
-			self.b2_voltage_pha = []
-			self.b2_current_pha = [] 
-			self.b2_voltage_phb = []
-			self.b2_current_phb = []
-			self.b2_voltage_phc = []
-			self.b2_current_phc = []
-			self.b2_status_phc = []
-			self.b2_ph_imbalance = []
-
 			self.alarm_state = True
 		else:
 			self.alarm_stop_time = time.time() * 1000
@@ -207,6 +291,18 @@ class Avalanche(object):
 
 		GPIO.add_event_detect(AVALANCHE_GPIO_ALARM, GPIO.BOTH, callback=self.alarm, bouncetime=50)
 
+		# DATA_RDY rising edges set the data ready event (see waitDataReady)
+		self._dataReady = threading.Event()
+		self._dataReadyMode = DATA_RDY_WAIT_MODE
+
+		if self._dataReadyMode == 'EDGE':
+			try:
+				GPIO.add_event_detect(AVALANCHE_GPIO_DATA_RDY, GPIO.RISING, callback=self.data_ready)
+
+			except RuntimeError as e:
+				self._logger.error("DATA_RDY edge detection failed ({0}) - polling instead".format(e))
+				self._dataReadyMode = 'POLL'
+
 		#initialize chip enables
 		#GPIO.setup(AVALANCHE_GPIO_SPI_CE0, GPIO.OUT, initial=GPIO.LOW)
 		#GPIO.setup(AVALANCHE_GPIO_SPI_CE1, GPIO.OUT, initial=GPIO.LOW)
@@ -224,6 +320,31 @@ class Avalanche(object):
 
 		self.tick = 0 # tracks sync time
 
+		# channel read timetable (see _buildTimetable) and loop count
+		self._order = []
+		self._timetable = [ [] ]
+		self._loop = 0
+
+		# per-bus channel readers (see setupChannels)
+		self._busReaders = None
+
+		# duration (s) of the updateChannels() stages in the last call
+		self.timing = { 'alarms': 0, 'read': 0, 'sync': 0 }
+
+		# SPI bus locks by bus_index (shared by channel reads and alarm capture)
+		self._spiLocks = {}
+
+		# an alarm capture holds its bus from the first block request to
+		# the last frame - channel reads on the bus are skipped meanwhile
+		# (see updateChannels and captureAlarm)
+		self._captureCondition = threading.Condition()
+		self._captureBuses = set() # buses held by an alarm capture
+		self._readingBuses = set() # buses with channel reads in flight
+
+		# Alarm waveforms are captured on a worker thread
+		self._alarmCapture = _AlarmCaptureWorker(self.captureAlarm)
+		self._alarmCapture.start()
+
 		self._logger.info("Enable/Powerup SPI devices")
 		self.enableSequence()
 
@@ -267,12 +388,6 @@ class Avalanche(object):
 		device_index = spi_config['device_index']
 
 		ch_rra = spi_config['rra']
-		
-		# configure SPI bus
-		spi = spidev.SpiDev()
-		spi.open(bus_index, 0)
-		spi.mode = 3 # (CPOL = 1 | CPHA = 1) (0b11)
-		spi.max_speed_hz = 5000000
 
 		# The STPM3X sensor read function as a closure to
 		# capture register, scale, and threshold config
@@ -286,6 +401,31 @@ class Avalanche(object):
 
 			return r
 
+		# The batch read function reads every sensor register of
+		# the channel (or of the sensors due, see _buildTimetable)
+		# in one pipelined burst (see Stpm3x.readMany)
+		def stpm3x_read_many(sensor_regs):
+
+			# ( sensor ids, registers, scales ) by the sIds read (None = all)
+			subsets = {}
+
+			def subset(read_sIds):
+				regs = [ r for r in sensor_regs if read_sIds is None or r[0] in read_sIds ]
+
+				sIds = [ sId for sId, register, scale, threshold in regs ]
+				scales = [ scale for sId, register, scale, threshold in regs ]
+				registers = [ (register, threshold) for sId, register, scale, threshold in regs ]
+
+				subsets[read_sIds] = (sIds, registers, scales)
+				return subsets[read_sIds]
+
+			def r(tick, read_sIds=None):
+				sIds, registers, scales = subsets.get(read_sIds) or subset(read_sIds)
+				values = stpm3x.readMany(registers, tick)
+				return { sId: v * scale for sId, v, scale in zip(sIds, values, scales) }
+
+			return r
+
 
 		# configure based on device type
 		if device_type == 'STPM3X':
@@ -293,11 +433,24 @@ class Avalanche(object):
 			# Create an STPM3X device object on the SPI bus and pass the configuration.
 			# See the STPM3X and Config class in the same module for configuration keys that
 			# can be set here to override the defaults in the module.
+			# Channels on the same device share the device object (and its
+			# register snapshot), so each register is read once per tick.
 			#self.selectSensor(device_index)
-			stpm3x = Stpm3x(spi, spi_config)
+			stpm3x = self.Devices.get((bus_index, device_index))
+
+			if not stpm3x:
+				# configure SPI bus
+				spi = spidev.SpiDev()
+				spi.open(bus_index, 0)
+				spi.mode = 3 # (CPOL = 1 | CPHA = 1) (0b11)
+				spi.max_speed_hz = 5000000
+
+				stpm3x = Stpm3x(spi, spi_config, self._spiLock(bus_index))
+				self.Devices[(bus_index, device_index)] = stpm3x
 
 			# Construct a list of sensors for which we have configuration objects (passed in on sensors)
 			_sensors = {}
+			_sensor_regs = []
 
 			for sId, s in sensors.items():
 
@@ -323,10 +476,13 @@ class Avalanche(object):
 				s_threshold = s_config.get('threshold', None)
 
 				# Add the sensor the the _sensors for the Channel
-				_sensors[sId] = _Sensor(sId, s_type, s_units, s_range, stpm3x_read(sId, device_index, s_register, s_scale, s_threshold))
+				_sensors[sId] = _Sensor(sId, s_type, s_units, s_range, stpm3x_read(sId, device_index, s_register, s_scale, s_threshold),
+					s_config.get('sample_rate_hz'))
+				_sensor_regs.append((sId, s_register, s_scale, s_threshold))
 				self._logger.info("\tSTPMX3 device sensor added (register: {0}, type: {1}, units: {2})".format(s_register, s_type, s_units))	
 
-			self.Channels[ch_id] = _Channel(ch_id, "SPI", bus_index, device_index, ch_rra, stpm3x.error, _sensors)
+			self.Channels[ch_id] = _Channel(ch_id, "SPI", bus_index, device_index, ch_rra, stpm3x.error, _sensors, stpm3x_read_many(_sensor_regs),
+				spi_config.get('sample_rate_hz'))
 			self._logger.info("CHANNEL ADDED: {0} SPI[{1}, {2}] STPM3X device with {3} sensors.\n\n".format(ch_id, bus_index, device_index, len(_sensors)))
 
 		else:
@@ -343,56 +499,8 @@ class Avalanche(object):
 
 		ch_rra = virtual_config['rra']
 
-		# defines the function called when sensors are read
-		def s_read(channels, sources, stype):
-
-			def r():
-				# find and get references to the source sensors
-				_sensor_values = []
-				for src in sources:
-					ref = src.split('.') # [ chId, sId ]
-					_ch = channels.get(ref[0])
-					if _ch:
-						_s = _ch.sensors.get(ref[1])
-					if _s and _s.values and len(_s.values) > 1 and _s.values[0] and len(_s.values[0]) > 1:
-						val = _s.values[0][1]
-						#print("{0}: {1}.{2} sensor value found: {3}".format(stype, _ch.id, _s.id, val))
-						_sensor_values.append(val)
-				
-				if stype == 'PIB':
-					# Phase Imbalance
-					if not _sensor_values or len(_sensor_values) < 3:
-						#print("ERROR: Not enough source sensor values to calculate phase imbalance.")
-						return 0
-
-					# Many references for this calculation, but here I'm going
-					# to use the maximum difference from average Vrms to calculate
-					Vsum = 0
-					for _s in _sensor_values:
-						Vsum = Vsum + _s
-					Vavg = Vsum / len(_sensor_values)  # RMS average of the phases
-
-					if Vavg == 0:
-						#print("PIB: Voltage average is zero cannot calculate phase imbalance")
-						return 0 # avoid div by zero
-
-					Vmax = 0
-					for _s in _sensor_values:
-						m = abs(Vavg - _s)
-						Vmax = m if m > Vmax else Vmax
-
-					PI = 100 * (Vmax / Vavg) # Phase Imbalance as percentage
-
-					#print("\n\t[ {0:.2f}, {1:.2f}, {2:.2f} ] Vmax: {3:.2f} Vavg: {4:.2f} PI: {5:.2f} %\n".format(_sensor_values[0], _sensor_values[1], _sensor_values[2], Vmax, Vavg, PI))
-					return PI
-
-				else:
-					self._logger.error("Unknown virtual channel type: {0}".format(stype))
-					return 0
-
-			return r
-
 		_sensors = {} # added to Channels as a dict
+		_formulas = {} # sensor formula configs (see Virtual.py)
 		for sId, s in sensors.items():
 
 			s_config = s['_config']
@@ -406,11 +514,15 @@ class Avalanche(object):
 			# set for the sensor.
 			s_sources = s_config['sources'] # [ chId.sId, ...]
 
-			# Add the sensor the the _sensors for the Channel
-			_sensors[sId] = _Sensor(sId, s_type, s_units, s_range, s_read(self.Channels, s_sources, s_type))
+			# Add the sensor the the _sensors for the Channel (the
+			# channel formulas compute its values)
+			_sensors[sId] = _Sensor(sId, s_type, s_units, s_range, None, s_config.get('sample_rate_hz'))
+			_formulas[sId] = (s_type, s_sources)
 			self._logger.info("\tVIRTUAL sensor added (type: {0}, units: {1})".format(s_type, s_units))	
 
-		self.Channels[ch_id] = _VirtualChannel(ch_id, ch_rra, False, _sensors)
+		# sources are resolved once all channels are set up (see setupChannels)
+		self.Channels[ch_id] = _VirtualChannel(ch_id, ch_rra, False, _sensors, VirtualFormulas(ch_id, _formulas),
+			virtual_config.get('sample_rate_hz'))
 		self._logger.info("CHANNEL ADDED: {0} VIRTUAL with {1} sensors.\n\n".format(ch_id, len(_sensors)))
 
 
@@ -454,6 +566,86 @@ class Avalanche(object):
 		for ch in sorted(self.Channels):
 			self._logger.info("\t{0}: {1}".format(ch, self.Channels[ch]))
 
+		# virtual channel sources can be in any channel, so they're
+		# resolved to the source sensors after all are set up
+		for ch in self.Channels.values():
+			if isinstance(ch, _VirtualChannel):
+				ch.formulas.resolve(self.Channels)
+
+		self._buildTimetable()
+
+		buses = set([ ch.bus_index for ch in self.Channels.values() if isinstance(ch, _Channel) ])
+
+		if self._busReaders:
+			self._busReaders.close()
+			self._busReaders = None
+
+		if SPI_PARALLEL_BUSES and len(buses) > 1:
+			self._busReaders = BusReaders(buses)
+
+	def _buildTimetable(self):
+		'''
+		Builds the rate-monotonic read timetable from the channel and sensor
+		"sample_rate_hz" settings.  A sensor (or channel) at rate R is read
+		every round(loop rate / R) loops; the timetable has one slot per loop
+		of the hyperperiod, each with the ( channel, sIds ) reads due in it.
+		Reads at the same rate are spread over the slots to even out the bus
+		load.  In each slot the physical channels are read first (fastest
+		first), then the virtual channels in dependency order.
+		'''
+		loop_hz = 1 / LOOP_PERIOD_s
+
+		order, cycles = evaluationOrder(self.Channels)
+		if cycles:
+			self._logger.error("Virtual channels {0} have (or depend on) circular sources - their values can lag by a tick".format(", ".join(cycles)))
+
+		self._order = [ self.Channels[chId] for chId in order ]
+		position = { chId: i for i, chId in enumerate(order) }
+
+		def divider(rate_hz):
+			if not rate_hz:
+				return 1
+
+			if rate_hz > loop_hz:
+				self._logger.warning("Sample rate {0} Hz is above the loop rate ({1} Hz)".format(rate_hz, loop_hz))
+
+			return max(1, int(round(loop_hz / rate_hz)))
+
+		# [ ( divider, channel, sIds (None = all sensors), read count ) ]
+		reads = []
+		for ch in self._order:
+			groups = {}
+			for s in ch.sensors.values():
+				groups.setdefault(divider(s.sample_rate_hz or ch.sample_rate_hz), []).append(s.id)
+
+			for d, sIds in groups.items():
+				reads.append((d, ch, None if len(groups) == 1 else frozenset(sIds), len(sIds)))
+
+		slots = 1
+		for d, ch, sIds, count in reads:
+			slots = slots * d // math.gcd(slots, d)
+
+		timetable = [ [] for i in range(slots) ]
+		load = [ 0 for i in range(slots) ]
+
+		# physical channels fastest first, then virtual channels in dependency
+		# order, each in the phase with the least load
+		def priority(r):
+			if isinstance(r[1], _VirtualChannel):
+				return (1, position[r[1].id], r[0])
+			return (0, r[0], position[r[1].id])
+
+		for d, ch, sIds, count in sorted(reads, key = priority):
+			phase = min(range(d), key = lambda p: max(load[p::d]))
+
+			for i in range(phase, slots, d):
+				timetable[i].append((ch, sIds))
+				load[i] += count
+
+		self._timetable = timetable
+		self._logger.info("Read timetable: {0} slots of {1:.3f} s, {2} to {3} sensor reads per slot".format(
+			slots, LOOP_PERIOD_s, min(load), max(load)))
+
 	def getChannelScales(self):
 		'''
 		'''
@@ -492,128 +684,196 @@ class Avalanche(object):
 		Runs through each channel's sensors and reads their value into the value property
 		'''
 
+		start_time = time.monotonic()
+
 		if self.alarm_state == True:
 			if GPIO.input(AVALANCHE_GPIO_ALARM) == GPIO.LOW:
-				'''
-				Get the system scale factors
-				'''
-				scales = self.getChannelScales()
-				inst_scales = []
+				# Alarm has ended - hand the waveform capture off to the
+				# alarm capture worker so the sensor reads below keep
+				# their cadence while the capture runs.
+				self.alarm_state = False
+				self._alarmCapture.submit(self.alarm_start_time, self.alarm_stop_time)
 
-				for scale in scales:
-					inst_scales.append(scale / 256)
+		read_time = time.monotonic()
 
+		# sensor registers were latched at the last sync, so the values
+		# read here are timestamped with the last sync time (tick)
+		if self._loop == 0:
+			# read everything once so all sensors have values
+			reads = [ (ch, None) for ch in self._order ]
+		else:
+			reads = self._timetable[self._loop % len(self._timetable)]
 
-				'''
-				Setup Alarm Structure
-				'''
-				self.alarm_state = False
-				
-				new_alarm = Alarm()
-				new_alarm.step_ms = 0.000512
-				new_alarm.start_ms = self.alarm_start_time
-				new_alarm.end_ms = self.alarm_stop_time
+		self._loop += 1
 
-				print("Reading Alarm Data...", end='')
-				
+		with self._captureCondition:
+			# the channels on buses held by an alarm capture keep their
+			# last values (marked stale) until the capture is done
+			for ch, sIds in reads:
+				if isinstance(ch, _Channel):
+					ch.stale = ch.bus_index in self._captureBuses
 
-				#configure SPI bus
-				spi = spidev.SpiDev()
-				spi.open(0, 0)
-				spi.mode = 3 # (CPOL = 1 | CPHA = 1) (0b11)
-				spi.max_speed_hz = 5000000
+			reads = [ r for r in reads if not r[0].stale ]
+			self._readingBuses = set([ ch.bus_index for ch, sIds in reads if isinstance(ch, _Channel) ])
+
+		try:
+			self._readChannels(reads)
+
+		finally:
+			with self._captureCondition:
+				self._readingBuses = set()
+				self._captureCondition.notify_all()
+
+		sync_time = time.monotonic()
+		
+		self.tick = self.syncSensors()
+
+		# register snapshots are only good for the tick they were read in
+		for dev in self.Devices.values():
+			dev.invalidateSnapshot(self.tick)
+
+		end_time = time.monotonic()
+
+		self.timing['alarms'] = read_time - start_time
+		self.timing['read'] = sync_time - read_time
+		self.timing['sync'] = end_time - sync_time
+
+		return self.Channels
+
+
+	def _readChannels(self, reads):
+		'''
+		Reads the ( channel, sIds ) reads of this tick
+		'''
+		if self._busReaders:
+			# physical channels are read on their bus readers (all buses
+			# at once), then the virtual channels from their values
+			self._busReaders.read(self.tick, [ r for r in reads if isinstance(r[0], _Channel) and not r[0].error ])
+			reads = [ r for r in reads if not isinstance(r[0], _Channel) ]
+
+		for ch, sIds in reads:
+			# update sensor values
+			if not ch.error:
+				ch.read(self.tick, sIds)
+
+
+	def busReadStats(self):
+		'''
+		Channel read timing by SPI bus index (empty if buses are read serially)
+		'''
+		return self._busReaders.stats() if self._busReaders else {}
+
+
+	def snapshotStats(self):
+		'''
+		Register snapshot hit/miss counters for each device (by "bus.device")
+		'''
+		return { "{0}.{1}".format(*k): dev.snapshotStats() for k, dev in self.Devices.items() }
+
+
+	def captureAlarm(self, start_ms, end_ms):
+		'''
+		Reads the alarm waveform data from the sensor bus and stores the alarm.
+		This runs on the alarm capture worker thread using its own SPI handle.
+		'''
+
+		'''
+		Get the system scale factors
+		'''
+		scales = self.getChannelScales()
+		inst_scales = []
+
+		for scale in scales:
+			inst_scales.append(scale / 256)
+
+
+		'''
+		Setup Alarm Structure
+		'''
+		new_alarm = Alarm()
+		new_alarm.step_ms = 0.000512
+		new_alarm.start_ms = start_ms
+		new_alarm.end_ms = end_ms
 
+		self._logger.info("Reading alarm data...")
+
+		# the bus is shared with the channel reads, which must not come
+		# in between a block request and its frame (or the pipelined
+		# register reads get out of step), so the capture holds the bus
+		# until done: channel reads on it are skipped (see updateChannels)
+		# once any in flight have finished.  The transfers still take the
+		# bus lock (other users of the bus), but not while waiting for
+		# DATA_RDY.
+		with self._captureCondition:
+			self._captureBuses.add(0)
+			self._captureCondition.wait_for(lambda: 0 not in self._readingBuses)
+
+		try:
+			return self._captureAlarm(new_alarm, inst_scales)
+
+		finally:
+			with self._captureCondition:
+				self._captureBuses.discard(0)
+
+
+	def _captureAlarm(self, new_alarm, inst_scales):
+		'''
+		Reads the alarm source and waveform blocks (bus 0 held, see captureAlarm)
+		'''
+		lock = self._spiLock(0)
+
+		#configure SPI bus
+		spi = spidev.SpiDev()
+		spi.open(0, 0)
+		spi.mode = 3 # (CPOL = 1 | CPHA = 1) (0b11)
+		spi.max_speed_hz = 5000000
+
+		self._dataReady.clear()
+
+		try:
+			with lock:
 				new_alarm = self.readAlarmSource(spi, new_alarm)
 
-				for sample in range(0,390*2):
-					#print("\nSend Block Request: %d", sample)
-					sampleMSB = (sample >> 8) & 0xFF
-					sampleLSB = (sample >> 0) & 0xFF				
+			# collect the raw frames into one buffer and
+			# decode them all at once when the capture is done
+			frames = bytearray()
+
+			for sample in range(0,390*2):
+				#print("\nSend Block Request: %d", sample)
+				sampleMSB = (sample >> 8) & 0xFF
+				sampleLSB = (sample >> 0) & 0xFF				
 
+				with lock:
 					spi.xfer2([0xF0, sampleLSB, sampleMSB, 0xFF, 0xFF])
-					self.readAlarmData(spi, inst_scales)
-
-				# for sample in range(0,390):
-				# 	self.b1_voltage_pha.append(500)
-				# 	self.b1_current_pha.append(500)
-				# 	self.b1_voltage_phb.append(500)
-				# 	self.b1_current_phb.append(500)
-				# 	self.b1_voltage_phc.append(500)
-				# 	self.b1_current_phc.append(500)
-				# 	self.b1_status_pha.append(500)
-				# 	self.b1_status_phb.append(500)
-				# 	self.b1_ph_imbalance.append(500)
-				# 	self.b2_voltage_pha.append(500)
-				# 	self.b2_current_pha.append(500)
-				# 	self.b2_voltage_phb.append(500)
-				# 	self.b2_current_phb.append(500)
-				# 	self.b2_voltage_phc.append(500)
-				# 	self.b2_current_phc.append(500)
-				# 	self.b2_status_phc.append(500)
-				# 	self.b2_ph_imbalance.append(500)
 
+				frames.extend(self.readAlarmData(spi, lock))
+
+			with lock:
 				spi.xfer2([0xF2, 0xFF, 0xFF, 0xFF, 0xFF])
 
-				spi.close()
-
-				# while GPIO.input(AVALANCHE_GPIO_ALARM) == GPIO.HIGH: {}
-				#print(new_alarm)
-				#spi.close()
-				#print("Alarm Ended")
-				# new_alarm.end_ms = 0
-
-				new_alarm.data = {
-					"ch0": {
-						"s0": self.b1_voltage_pha
-					},
-					"ch1": {
-						"s0": self.b1_voltage_phb
-					},
-					"ch2": {
-						"s0": self.b1_voltage_phc
-					},
-					"ch3": {
-						"s0": self.b1_ph_imbalance
-					},
-					"ch4": {
-						"s0": self.b2_voltage_pha,
-						"s1": self.b2_current_pha
-					},
-					"ch5": {
-						"s0": self.b2_voltage_phb,
-						"s1": self.b2_current_phb
-					},
-					"ch6": {
-						"s0": self.b2_voltage_phc,
-						"s1": self.b2_current_phc
-					},
-					"ch7": {
-						"s0": self.b2_ph_imbalance
-					}
-				}
-
-				# print(new_alarm)
-				# print(new_alarm.data)
-
-				# print("B2 Voltage PHA")
-				# print(self.b2_voltage_pha)
-				# print("")
-				self.alarmManager.InsertAlarm(new_alarm)
-				print("Finished")
-				print(new_alarm)
-
-
- 
-		for ch in self.Channels.values():
-			# update sensor values
-			if not ch.error:
-				for s in ch.sensors.values():
-					s.read(self.tick)
+		finally:
+			spi.close()
 
-		
-		self.tick = self.syncSensors()
+		new_alarm.data = decodeAlarmFrames(frames, inst_scales)
 
-		return self.Channels
+		self.alarmManager.InsertAlarm(new_alarm)
+		self._logger.info("Alarm queued for storage: {0}".format(new_alarm))
+
+		return new_alarm
+
+
+	def alarmCaptureStats(self):
+		'''
+		Alarm capture worker metrics (capture durations and queue depth)
+		'''
+		return self._alarmCapture.stats()
+
+
+	def _spiLock(self, bus_index):
+		'''
+		Returns the lock that serializes transactions on an SPI bus
+		'''
+		return self._spiLocks.setdefault(bus_index, threading.RLock())
 
 
 	def readAlarmSource(self, handle, alarm):
@@ -692,81 +952,69 @@ class Avalanche(object):
 		return alarm
 
 
-	def readAlarmData(self, handle, scales):
-		txArray = []
-		rxArray = []
-
-		for i in range(0,112):
-			txArray.append(i)
-
+	def readAlarmData(self, handle, lock):
+		'''
+		Reads one alarm data frame (see AlarmFrames for the layout) after
+		a block request and returns the raw frame bytes.  The bus lock is
+		taken for the transfer only, once DATA_RDY is high.
+		'''
+		txArray = list(range(0, ALARM_FRAME_SIZE))
 		txArray[0] = 0xF1
 
 		# Wait for data to be ready
 		#print("Waiting for Data Ready signal...") 
-		while GPIO.input(AVALANCHE_GPIO_DATA_RDY) == GPIO.LOW: {}
+		if not self.waitDataReady():
+			raise IOError("Timed out waiting for alarm data (DATA_RDY)")
+
 		#print("Read...")
 		#time.sleep(0.01)
-		rxArray = handle.xfer2(txArray)
-
-		crc32  		 = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[0:4])
-		ncrc32		 = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[4:8])
-
-		self.b1_voltage_pha.append(Stpm3x.convert_raw(Stpm3x, rxArray[8:12], 'V1DATA', 0) * scales[0])
-		self.b1_current_pha.append(Stpm3x.convert_raw(Stpm3x, rxArray[12:16], 'C1DATA', 0) * 0.02037096)
-		self.b1_voltage_phb.append(Stpm3x.convert_raw(Stpm3x, rxArray[16:20], 'V1DATA', 0) * scales[1])
-		self.b1_current_phb.append(Stpm3x.convert_raw(Stpm3x, rxArray[20:24], 'C1DATA', 0) * 0.02037096)
-		#b1_crmsvrms_pha = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[24:28])
-		#b1_crmsvrms_phb = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[28:32])
-		#b1_status_pha = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[32:36])
-		#b1_status_phb = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[36:40])
-		self.b1_voltage_phc.append(Stpm3x.convert_raw(Stpm3x, rxArray[40:44], 'V1DATA', 0) * scales[2])
-		self.b1_current_phc.append(Stpm3x.convert_raw(Stpm3x, rxArray[44:48], 'C1DATA', 0) * 0.02037096)
-		#b1_crmsvrms_phc = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[48:52])
-		#b1_status_phc = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[52:56])
-		self.b1_ph_imbalance.append(Stpm3x._bytes2int32_rev(Stpm3x, rxArray[56:60]) / 1000)
-
-		self.b2_voltage_pha.append(Stpm3x.convert_raw(Stpm3x, rxArray[60:64], 'V1DATA', 0) * scales[3])
-		self.b2_current_pha.append(Stpm3x.convert_raw(Stpm3x, rxArray[64:68], 'C1DATA', 0) * scales[4])
-		self.b2_voltage_phb.append(Stpm3x.convert_raw(Stpm3x, rxArray[68:72], 'V1DATA', 0) * scales[5])
-		self.b2_current_phb.append(Stpm3x.convert_raw(Stpm3x, rxArray[72:76], 'C1DATA', 0) * scales[6])
-		#b2_crmsvrms_pha = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[76:80])
-		#b2_crmsvrms_phb = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[80:84])
-		#b2_status_pha = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[84:88])
-		#b2_status_phb = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[88:92])
-		self.b2_voltage_phc.append(Stpm3x.convert_raw(Stpm3x, rxArray[92:96], 'V1DATA', 0) * scales[7])
-		self.b2_current_phc.append(Stpm3x.convert_raw(Stpm3x, rxArray[96:100], 'C1DATA', 0) * scales[8])
-		#b2_crmsvrms_phc = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[100:104])
-		#b2_status_phc = Stpm3x._bytes2int32_rev(Stpm3x, rxArray[104:108])
-		self.b2_ph_imbalance.append(Stpm3x._bytes2int32_rev(Stpm3x, rxArray[108:112]) / 1000)
-
-		'''
-		#print(rxArray)
-		print("CRC32      : %08x" % crc32)
-		print("~CRC32     : %08x" % ncrc32)
-		print("Voltage PhA: ", voltage_pha)
-		print("Current PhA: ", current_pha)
-		print("Voltage PhB: ", voltage_phb)
-		print("Current PhB: ", current_phb)
-		print("Voltage PhC: ", voltage_phc)
-		print("Voltage PhC: ", current_phc)
-		print("Phase Imb  : ", ph_imbalance)
-
-		input("Press Enter to continue...")'''
-		#self.alarmData.append(rxArray)
+		with lock:
+			rxArray = handle.xfer2(txArray)
+
+		# re-arm for the next block
+		self._dataReady.clear()
+
+		return rxArray
+
+
+	def waitDataReady(self):
+		'''
+		Waits (without spinning) for the DATA_RDY line to go high.  Returns
+		False if it doesn't within DATA_RDY_TIMEOUT_s.
+		'''
+		if GPIO.input(AVALANCHE_GPIO_DATA_RDY) == GPIO.HIGH:
+			return True
+
+		if self._dataReadyMode == 'EDGE':
+			return self._dataReady.wait(DATA_RDY_TIMEOUT_s) or GPIO.input(AVALANCHE_GPIO_DATA_RDY) == GPIO.HIGH
+
+		deadline = time.time() + DATA_RDY_TIMEOUT_s
+		poll_s = DATA_RDY_POLL_MIN_s
+
+		while GPIO.input(AVALANCHE_GPIO_DATA_RDY) == GPIO.LOW:
+			if time.time() > deadline:
+				return False
+
+			time.sleep(poll_s)
+			poll_s = min(2 * poll_s, DATA_RDY_POLL_MAX_s)
+
+		return True
 
 
 
 	def syncSensors(self):
 		'''
 		STPM3X sensors can be sync'd by briefly pulling the sync line Low for
-		each sensor board.
+		each sensor board.  Returns the sync time (when the line went Low).
 		'''
 		GPIO.output(AVALANCHE_GPIO_SYNC_SENSOR0, GPIO.LOW)
-		time.sleep(0.001)
+		tick = time.time()
+		time.sleep(SYNC_PULSE_s)
 		GPIO.output(AVALANCHE_GPIO_SYNC_SENSOR0, GPIO.HIGH)
-		time.sleep(0.001)
 
-		return time.time()
+		# the registers are read on the next loop, so there's no need to
+		# wait here after the pulse
+		return tick
 
 
 	def setSync(self):
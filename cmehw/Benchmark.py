@@ -0,0 +1,324 @@
+# Micro-benchmarks for the hardware loop hot paths
+#
+# Run on the target (Raspberry Pi) to compare the per-call cost of
+# the implementations, e.g.:
+#
+#	$ python -m cmehw.Benchmark crc8
+
+import sys, time, timeit, random
+
+
+def _report(name, count, seconds, unit='frame'):
+	print("\t{0:<32} {1:10.3f} us/{2}".format(name, 1e6 * seconds / count, unit))
+
+
+def crc8(count=10000):
+	''' STPM3X frame CRC-8: table-driven check vs. the original crcmod path
+		that built the CRC function and packed an int on every frame.
+	'''
+	from .STPM3X import checkCrc8, checkCrc8Frames, calcCrc8
+
+	frames = []
+	for i in range(count):
+		data = [ random.randint(0, 255) for b in range(4) ]
+		frames.append(data + [ calcCrc8(data) ])
+
+	print("CRC-8 ({0} frames)".format(count))
+
+	try:
+		import struct
+		import crcmod.predefined
+
+		def crcmod_check(f):
+			packet = (f[0] << 24) + (f[1] << 16) + (f[2] << 8) + f[3]
+			crc8_func = crcmod.predefined.mkCrcFun('crc-8')
+			return crc8_func(struct.pack('>I', packet)) == f[4]
+
+		t = timeit.timeit(lambda: [ crcmod_check(f) for f in frames ], number=1)
+		_report("crcmod (per frame mkCrcFun)", count, t)
+
+	except ImportError:
+		print("\tcrcmod not installed - skipping original implementation")
+
+	t = timeit.timeit(lambda: [ checkCrc8(f) for f in frames ], number=1)
+	_report("checkCrc8", count, t)
+
+	t = timeit.timeit(lambda: checkCrc8Frames(frames), number=1)
+	_report("checkCrc8Frames (bulk)", count, t)
+
+
+def alarm_decode(count=780):
+	''' Alarm waveform decode: per-frame field slicing through
+		Stpm3x.convert_raw() vs. one struct pass over all frames.
+	'''
+	from .STPM3X import Stpm3x
+	from .AlarmFrames import ALARM_FRAME_SIZE, decodeAlarmFrames
+
+	scales = [ random.random() / 256 for i in range(9) ]
+	frames = bytearray(random.getrandbits(8) for i in range(count * ALARM_FRAME_SIZE))
+
+	print("Alarm decode ({0} frames)".format(count))
+
+	def convert_raw_decode():
+		v = []
+		for f in range(count):
+			rx = list(frames[f * ALARM_FRAME_SIZE:(f + 1) * ALARM_FRAME_SIZE])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[8:12], 'V1DATA', 0) * scales[0])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[16:20], 'V1DATA', 0) * scales[1])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[40:44], 'V1DATA', 0) * scales[2])
+			v.append(Stpm3x._bytes2int32_rev(Stpm3x, rx[56:60]) / 1000)
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[60:64], 'V1DATA', 0) * scales[3])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[64:68], 'C1DATA', 0) * scales[4])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[68:72], 'V1DATA', 0) * scales[5])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[72:76], 'C1DATA', 0) * scales[6])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[92:96], 'V1DATA', 0) * scales[7])
+			v.append(Stpm3x.convert_raw(Stpm3x, rx[96:100], 'C1DATA', 0) * scales[8])
+			v.append(Stpm3x._bytes2int32_rev(Stpm3x, rx[108:112]) / 1000)
+		return v
+
+	t = timeit.timeit(convert_raw_decode, number=1)
+	_report("Stpm3x.convert_raw", count, t)
+
+	t = timeit.timeit(lambda: decodeAlarmFrames(frames, scales), number=1)
+	_report("decodeAlarmFrames", count, t)
+
+	# both must produce the same samples
+	data = decodeAlarmFrames(frames, scales)
+	columns = [ data[ch][s] for ch, s in [ ('ch0', 's0'), ('ch1', 's0'), ('ch2', 's0'), ('ch3', 's0'),
+		('ch4', 's0'), ('ch4', 's1'), ('ch5', 's0'), ('ch5', 's1'), ('ch6', 's0'), ('ch6', 's1'), ('ch7', 's0') ] ]
+	assert [ v for sample in zip(*columns) for v in sample ] == convert_raw_decode()
+
+
+def alarm_storage(count=780):
+	''' Alarm waveform storage: JSON text of the whole data structure
+		vs. packed float32 blobs per channel sensor.
+	'''
+	import json
+	from .Waveforms import packWaveform, unpackWaveform
+
+	data = { 'ch{0}'.format(c): { 's0': [ random.uniform(-400, 400) for i in range(count) ],
+		's1': [ random.uniform(-50, 50) for i in range(count) ] } for c in range(8) }
+
+	print("Alarm storage (16 waveforms x {0} samples)".format(count))
+
+	text = json.dumps(data)
+	t_dump = timeit.timeit(lambda: json.dumps(data), number=10) / 10
+	t_load = timeit.timeit(lambda: json.loads(text), number=10) / 10
+	print("\t{0:<32} {1:10d} bytes {2:8.3f} ms encode {3:8.3f} ms decode".format("json", len(text), 1e3 * t_dump, 1e3 * t_load))
+
+	for compress in [ False, True ]:
+		pack = lambda: [ packWaveform(v, 0.512, compress=compress) for ch in data.values() for v in ch.values() ]
+		blobs = pack()
+		t_dump = timeit.timeit(pack, number=10) / 10
+		t_load = timeit.timeit(lambda: [ unpackWaveform(b) for b in blobs ], number=10) / 10
+		name = "float32 + zlib" if compress else "float32"
+		print("\t{0:<32} {1:10d} bytes {2:8.3f} ms encode {3:8.3f} ms decode".format(name, sum(len(b) for b in blobs), 1e3 * t_dump, 1e3 * t_load))
+
+
+def alarm_query(count=100000, page=50):
+	''' Alarm query page fetches from a synthetic alarms database
+	'''
+	import os, tempfile, sqlite3
+	from .Alarms import AlarmManager
+
+	tmpdir = tempfile.TemporaryDirectory()
+	path = os.path.join(tmpdir.name, 'alarms.db')
+	manager = AlarmManager(path)
+
+	try:
+		types = [ 'SAG', 'SWELL', 'OUTAGE', 'IMBALANCE' ]
+		start_ms = 1500000000000
+		rows = [ ('ch{0}'.format(random.randint(0, 7)), 's0', random.choice(types), start_ms + i * 60000, start_ms + i * 60000 + 50, 0.512)
+			for i in range(count) ]
+
+		connection = sqlite3.connect(path)
+		try:
+			with connection: # commits
+				connection.executemany('INSERT INTO alarms(channel, sensor, type, start_ms, end_ms, step_ms) VALUES(?, ?, ?, ?, ?, ?)', rows)
+		finally:
+			connection.close()
+
+		print("Alarm query ({0} alarms, {1} per page)".format(count, page))
+
+		def report(name, query, number=20):
+			t = timeit.timeit(query, number=number) / number
+			print("\t{0:<32} {1:10.3f} ms/page".format(name, 1e3 * t))
+
+		last = manager.QueryAlarms(limit=page, offset=count // 2)[-1]
+
+		report("newest", lambda: manager.QueryAlarms(limit=page))
+		report("channel", lambda: manager.QueryAlarms(channel='ch3', limit=page))
+		report("type + time range", lambda: manager.QueryAlarms(alarm_type='SAG', start_ms=start_ms, end_ms=start_ms + count * 30000, limit=page))
+		report("channel + type", lambda: manager.QueryAlarms(channel='ch3', alarm_type='OUTAGE', limit=page))
+		report("deep page (offset)", lambda: manager.QueryAlarms(limit=page, offset=count // 2))
+		report("deep page (keyset cursor)", lambda: manager.QueryAlarms(limit=page, before=(last.start_ms, last.id)))
+
+	finally:
+		manager.Close()
+		tmpdir.cleanup()
+
+
+def segments(count=36000, channels=8):
+	''' Segment store publish (one row per channel) and range reads
+	'''
+	import os, tempfile
+	from .Segments import SegmentStore
+	from .SampleBuffer import SampleBuffer
+
+	class Sensor():
+		def __init__(self, id):
+			self.id = id
+			self.values = SampleBuffer(1)
+
+	class Channel():
+		def __init__(self, id):
+			self.id = id
+			self.error = False
+			self.stale = False
+			self.sensors = { s: Sensor(s) for s in [ 's0', 's1', 's2' ] }
+
+	tmpdir = tempfile.TemporaryDirectory()
+	store = SegmentStore(os.path.join(tmpdir.name, 'segments'))
+	chs = [ Channel('ch{0}'.format(c)) for c in range(channels) ]
+
+	try:
+		print("Segments ({0} channels x {1} samples at 10 Hz)".format(channels, count))
+
+		start_s = 1500000000
+		def publish():
+			for i in range(count):
+				for ch in chs:
+					for s in ch.sensors.values():
+						s.values.push(start_s + i * 0.1, random.uniform(0, 300))
+				store.publishBatch(chs)
+
+		t = timeit.timeit(publish, number=1)
+		print("\t{0:<32} {1:10.3f} us/row".format("publish", 1e6 * t / (count * channels)))
+
+		start_ms = start_s * 1000
+		for minutes in [ 1, 15, 60 ]:
+			t = timeit.timeit(lambda: store.read('ch3', start_ms, start_ms + minutes * 60000), number=20) / 20
+			print("\t{0:<32} {1:10.3f} ms".format("read {0} min".format(minutes), 1e3 * t))
+
+	finally:
+		store.close()
+		tmpdir.cleanup()
+
+
+def sample_buffer(count=100000, size=60):
+	''' Sensor value push: the original deque of [ tick, value ] lists vs.
+		the SampleBuffer ring
+	'''
+	from collections import deque
+	from .SampleBuffer import SampleBuffer
+
+	print("Sample buffer ({0} pushes, {1} points)".format(count, size))
+
+	# both are pushed through one call per sample, as the
+	# channel reads do (the deque push was in _Sensor.read)
+	values = deque([ None for x in range(size) ])
+	def deque_push(tick, value):
+		values.appendleft([ tick, value ])
+		values.pop()
+
+	def push_deque():
+		for i in range(count):
+			deque_push(i, 1.0)
+
+	ring = SampleBuffer(size)
+	def push_ring():
+		for i in range(count):
+			ring.push(i, 1.0)
+
+	_report("deque", count, timeit.timeit(push_deque, number=1), 'sample')
+	_report("SampleBuffer", count, timeit.timeit(push_ring, number=1), 'sample')
+
+	latest_deque = lambda: values[0][1]
+	_report("deque values[0][1]", count, timeit.timeit(latest_deque, number=count), 'sample')
+	_report("SampleBuffer.latestValue()", count, timeit.timeit(ring.latestValue, number=count), 'sample')
+	_report("SampleBuffer.last({0})".format(size), count, timeit.timeit(lambda: ring.last(size), number=count), 'call')
+
+
+def bus_readers(ticks=50, buses=3, devices=2, latency_s=0.0002):
+	''' Channel reads on several SPI buses: serial vs. the per-bus readers.
+		The SPI devices are fakes that answer every transfer after latency_s
+		with a valid STPM3X frame.
+	'''
+	import threading
+	from .STPM3X import Stpm3x, calcCrc8
+	from .BusReaders import BusReaders
+
+	class FakeSpiDev():
+		def __init__(self):
+			self.transfers = 0
+
+		def xfer2(self, data):
+			time.sleep(latency_s)
+			self.transfers += 1
+			frame = [ random.randint(0, 255) for b in range(4) ]
+			return frame + [ calcCrc8(frame) ]
+
+	class Channel():
+		def __init__(self, bus_index, device):
+			self.bus_index = bus_index
+			self.error = False
+			self._device = device
+
+		def read(self, tick, sIds=None):
+			self._device.readMany([ ('V1RMS', None), ('C1RMS', None), ('V2RMS', None), ('C2RMS', None) ], tick)
+
+	chs = []
+	for b in range(buses):
+		lock = threading.RLock() # shared by the devices on a bus
+		for d in range(devices):
+			chs.append(Channel(b, Stpm3x(FakeSpiDev(), { 'bus_index': b, 'device_index': d }, lock)))
+
+	print("Bus readers ({0} buses x {1} devices, {2:.3f} ms per transfer)".format(buses, devices, 1e3 * latency_s))
+
+	def report(name, t):
+		print("\t{0:<32} {1:10.3f} ms/tick".format(name, 1e3 * t / ticks))
+
+	def serial():
+		for tick in range(ticks):
+			for ch in chs:
+				ch.read(tick)
+
+	report("serial", timeit.timeit(serial, number=1))
+
+	readers = BusReaders([ ch.bus_index for ch in chs ])
+	reads = [ (ch, None) for ch in chs ]
+
+	def parallel():
+		for tick in range(ticks):
+			readers.read(ticks + tick, reads)
+
+	report("per-bus readers", timeit.timeit(parallel, number=1))
+
+	for b, stats in readers.stats().items():
+		print("\t\tbus {0}: {1} ticks, avg {2:.3f} ms, max {3:.3f} ms".format(b, stats['ticks'], 1e3 * stats['avg_read_s'], 1e3 * stats['max_read_s']))
+
+	readers.close()
+
+
+BENCHMARKS = {
+	'alarm_decode': alarm_decode,
+	'alarm_query': alarm_query,
+	'alarm_storage': alarm_storage,
+	'bus_readers': bus_readers,
+	'crc8': crc8,
+	'sample_buffer': sample_buffer,
+	'segments': segments
+}
+
+
+def main(args=None):
+
+	if args is None:
+		args = sys.argv[1:]
+
+	for name in (args or sorted(BENCHMARKS)):
+		BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,126 @@
+# Parallel SPI bus reads
+#
+# Channels on different SPI buses can be read at the same time: each bus
+# gets a reader thread, and every tick the main loop hands each reader the
+# reads due on its bus and waits at a barrier until all buses are done.
+# All channels read in a tick share the tick timestamp, and the loop
+# continues (virtual channels, sync, publish) only once every bus has
+# finished.  Channels on the same bus (other chip selects) share the bus,
+# so they're read one after the other by that bus' reader.
+#
+# Nothing here touches the hardware directly - the readers call the
+# channels' read(tick, sIds), so this can be exercised with fake SPI
+# devices (see the 'bus_readers' benchmark).
+
+import time, threading, logging
+
+
+class _BusReader(threading.Thread):
+	''' Reads the channels of one bus when released by the tick barrier '''
+
+	def __init__(self, bus_index, start_barrier, done_barrier):
+		super(_BusReader, self).__init__(name='BusReader{0}'.format(bus_index), daemon=True)
+
+		self.bus_index = bus_index
+		self._start = start_barrier
+		self._done = done_barrier
+
+		self.reads = [] # [ ( channel, sIds ) ] for the current tick
+		self.tick = None
+		self.error = None
+		self.stopping = False
+
+		self.ticks = 0
+		self.channels = 0
+		self.last_read_s = 0
+		self.max_read_s = 0
+		self.total_read_s = 0
+
+	def run(self):
+		while True:
+			self._start.wait()
+
+			if self.stopping:
+				break
+
+			self.error = None
+			start_time = time.monotonic()
+
+			try:
+				for ch, sIds in self.reads:
+					ch.read(self.tick, sIds)
+
+			except Exception as e:
+				self.error = e
+
+			read_s = time.monotonic() - start_time
+
+			if self.reads:
+				self.ticks += 1
+				self.channels += len(self.reads)
+				self.last_read_s = read_s
+				self.max_read_s = max(self.max_read_s, read_s)
+				self.total_read_s += read_s
+
+			self._done.wait()
+
+	def stats(self):
+		return {
+			'ticks': self.ticks,
+			'channels': self.channels,
+			'last_read_s': self.last_read_s,
+			'max_read_s': self.max_read_s,
+			'avg_read_s': self.total_read_s / self.ticks if self.ticks else 0
+		}
+
+
+
+class BusReaders():
+	''' Per-bus reader threads for the physical channels '''
+
+	def __init__(self, bus_indexes):
+		self._logger = logging.getLogger(__name__)
+
+		bus_indexes = sorted(set(bus_indexes))
+
+		# the main thread is a party to both barriers
+		self._start = threading.Barrier(len(bus_indexes) + 1)
+		self._done = threading.Barrier(len(bus_indexes) + 1)
+
+		self._readers = { b: _BusReader(b, self._start, self._done) for b in bus_indexes }
+		for reader in self._readers.values():
+			reader.start()
+
+		self._logger.info("SPI bus readers started for buses {0}".format(bus_indexes))
+
+	def read(self, tick, reads):
+		''' Reads the ( channel, sIds ) reads - each on its channel's bus
+			reader - and returns when all buses are done.  The first read
+			error (if any) is raised here.
+		'''
+		for reader in self._readers.values():
+			reader.tick = tick
+			reader.reads = []
+
+		for ch, sIds in reads:
+			self._readers[ch.bus_index].reads.append((ch, sIds))
+
+		self._start.wait() # release the readers
+		self._done.wait() # and wait for all of them
+
+		for reader in self._readers.values():
+			if reader.error:
+				raise reader.error
+
+	def stats(self):
+		''' Read timing by bus index '''
+		return { b: reader.stats() for b, reader in self._readers.items() }
+
+	def close(self):
+		for reader in self._readers.values():
+			reader.stopping = True
+
+		self._start.wait()
+
+		for reader in self._readers.values():
+			reader.join()
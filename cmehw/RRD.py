@@ -1,8 +1,10 @@
-import os, logging, glob, sys, time, random, re
+import os, logging, glob, sys, time, random, re, socket
 import rrdtool
 
 from .common import Config
 
+from .Sink import Sink
+
 # The location where channel data and configuration are stored (typically /data/channels/)
 CHDIR = Config.PATHS.CHDIR
 
@@ -24,6 +26,26 @@ without greatly impacting the other layers.
 '''
 RRDCACHED = Config.RRD.RRDCACHED
 
+# If a batch can't be sent to rrdcached, updates go directly to the
+# RRD files and the daemon is retried after this many seconds.
+RRDCACHED_RETRY_s = 10
+
+# Channel RRD filenames and update formats are cached between publishes.
+# CHDIR is checked for "chX.rrd.reset" files (and removed RRDs) at most
+# this often, and only when the folder's mtime has changed.
+RRD_RESCAN_s = 5
+
+# Channel RRD step (rrdtool steps are whole seconds).  Changes apply to
+# newly created RRDs only (see the "chX.rrd.reset" file in publish).
+RRD_STEP_s = 1
+
+# High-rate mode: if > 0, publishBatch() buffers every new sample at its
+# read (tick) timestamp and writes them every RRD_FLUSH_s seconds as one
+# multi-timestamp update per channel.  Samples taken faster than the RRD
+# step are time-weighted into the step's data point by rrdtool.  If 0,
+# only the latest sample is written on each publish.
+RRD_FLUSH_s = 0
+
 # This is an rrd that's created at init to ensure the RRD system
 # is working properly.  Note that the full path to the file is not
 # given, as that should be handled (encapsulated) by the cache daemon
@@ -66,7 +88,131 @@ def _rrdfetch(rrdfile, *args):
 	return rrdtool.fetch(os.path.join(CHDIR, rrdfile), *args)
 
 
-class RRD():
+class _RrdCachedClient():
+	''' Persistent connection to the rrdcached daemon for BATCH updates.
+		The RRDCACHED address is a unix socket ("unix:/path" or "/path")
+		or a TCP "host[:port]".
+	'''
+	DEFAULT_PORT = 42217
+	TIMEOUT_s = 2
+
+	def __init__(self, address):
+		self._address = address
+		self._sock = None
+		self._file = None
+
+	def _connect(self):
+		address = self._address
+
+		if address.startswith('unix:'):
+			address = address[len('unix:'):]
+
+		if address.startswith('/'):
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.settimeout(self.TIMEOUT_s)
+			sock.connect(address)
+		else:
+			host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+			sock = socket.create_connection((host, int(port) if port else self.DEFAULT_PORT), self.TIMEOUT_s)
+
+		self._sock = sock
+		self._file = sock.makefile('rwb')
+
+	def close(self):
+		if self._sock:
+			try:
+				self._file.close()
+				self._sock.close()
+			except OSError:
+				pass
+
+		self._sock = None
+		self._file = None
+
+	def _readline(self):
+		line = self._file.readline()
+		if not line:
+			raise OSError("rrdcached closed the connection")
+		return line.decode().rstrip('\n')
+
+	def batch(self, commands):
+		''' Sends the commands in one BATCH session.  Returns the list of
+			error lines (if any) reported by the daemon.
+		'''
+		if not self._sock:
+			self._connect()
+
+		self._file.write(b'BATCH\n')
+		self._file.flush()
+
+		status = self._readline() # "0 Go ahead. End with dot '.' on its own line."
+		if not status.startswith('0'):
+			raise OSError("rrdcached BATCH refused: {0}".format(status))
+
+		self._file.write(''.join([ c + '\n' for c in commands ]).encode() + b'.\n')
+		self._file.flush()
+
+		# "<N> errors" followed by N error lines
+		errors = int(self._readline().split(' ', 1)[0])
+		return [ self._readline() for e in range(errors) ]
+
+
+
+class _RrdDescriptor():
+	''' Cached publish state of a channel - the RRD filename, the sensors
+		in DS order and the update argument format.
+	'''
+
+	def __init__(self, channel, ch_rrd, sorted_sensors):
+		self.rrd = ch_rrd
+		self.path = os.path.join(CHDIR, ch_rrd)
+		self.reset = os.path.join(CHDIR, channel.id + '.rrd.reset')
+		self.sensors = sorted_sensors
+
+		# "{}:{:f}:{:f}..." - timestamp then one value per DS
+		self.format = ':'.join([ '{}' ] + [ '{:f}' ] * len(sorted_sensors))
+
+		# update arguments waiting to be written (see RRD.publishBatch)
+		self.pending = []
+		self._last_tick = None
+
+		# channel sensors this was built from (see matches())
+		self._channel_sensors = channel.sensors
+		self._sensor_count = len(channel.sensors)
+
+	def matches(self, channel):
+		''' False if the channel's sensors were changed (e.g., config reload) '''
+		return channel.sensors is self._channel_sensors and len(channel.sensors) == self._sensor_count
+
+	def stale(self):
+		''' True if the channel RRD is to be reset or has been removed '''
+		return os.path.isfile(self.reset) or not os.path.isfile(self.path)
+
+	def values(self, timestamp):
+		''' Returns the rrdtool update argument (timestamp:v0:v1:...) '''
+		return self.format.format(timestamp, *[ s.values.latestValue() for s in self.sensors ])
+
+	def buffer(self):
+		''' Adds the latest sample to pending at its read (tick) timestamp,
+			unless it was already buffered.
+		'''
+		if not self.sensors:
+			return
+
+		ticks = [ s.values.latestTick() for s in self.sensors ]
+		if None in ticks:
+			return # not all sensors read yet
+
+		# newest sample time (sensors can be read at different rates)
+		tick = max(ticks)
+
+		if tick != self._last_tick:
+			self._last_tick = tick
+			self.pending.append(self.values('{:.3f}'.format(tick)))
+
+
+
+class RRD(Sink):
 
 	def __init__(self):
 		''' Verify connection to rrdcached on init
@@ -124,6 +270,28 @@ class RRD():
 
 		self._logger.info("RRD setup finished")
 
+		# batch updates go over a persistent rrdcached connection
+		self._rrdcached = _RrdCachedClient(RRDCACHED) if RRDCACHED else None
+		self._rrdcached_retry = 0
+
+		# publish descriptors by channel id (see _descriptor)
+		self._descriptors = {}
+		self._flush_time = time.time()
+		self._chdir_mtime = None
+		self._rescan_time = 0
+
+		# publishBatch timing counters
+		self.batch_stats = {
+			'batches': 0,
+			'channels': 0,
+			'samples': 0,
+			'last_batch_s': 0,
+			'max_batch_s': 0,
+			'reconnects': 0,
+			'fallbacks': 0,
+			'errors': 0
+		}
+
 
 	def publish(self, channel):
 		''' Publish channel data to an RRD.  Each sensor in the channel is assigned a DS (data source)
@@ -147,6 +315,177 @@ class RRD():
 		if channel.error or channel.stale:
 			return
 
+		descriptor = self._descriptor(channel, time.time())
+
+		# Create the update argument for the channel's RRD
+		# These have to go in order of the channel's sensor DS's (s0_, s1_, ...)
+		DATA_UPDATE = descriptor.values('N')
+
+		#self._logger.debug("RRD update: " + DATA_UPDATE) 
+
+		# try/catch to watch out for updates that occur too often.  Here we just
+		# log and ignore the exception (for now).  This may just be related to
+		# an issue with the RRDCacheD and floating point rounding errors.
+		# (JJB) NOTE: Rrdtool has a command switch to silently ignore these errors
+		# which I've turned on as the errors were filling up the syslog.
+		try:
+			_rrdupdate(descriptor.rrd, DATA_UPDATE)
+
+		except:
+			self._logger.error(sys.exc_info()[1])
+
+
+	def publishBatch(self, channels):
+		''' Publish the data of several channels in one go.  With RRDCACHED
+			set, the updates are sent in a single BATCH over a persistent
+			daemon connection (reconnecting once on failure) and fall back
+			to updating the RRD files directly if the daemon is unreachable.
+
+			In high-rate mode (RRD_FLUSH_s > 0) samples are buffered and only
+			written every RRD_FLUSH_s seconds (see flush).
+		'''
+		now = time.time()
+
+		# rrdcached needs the timestamp (the rrdtool client converts 'N')
+		timestamp = str(int(now))
+
+		for channel in channels:
+			if channel.error or channel.stale:
+				continue
+
+			descriptor = self._descriptor(channel, now)
+
+			if RRD_FLUSH_s > 0:
+				descriptor.buffer()
+			else:
+				descriptor.pending.append(descriptor.values(timestamp))
+
+		if RRD_FLUSH_s > 0 and now - self._flush_time < RRD_FLUSH_s:
+			return
+
+		self.flush()
+
+
+	def flush(self):
+		''' Writes all pending channel updates - one update per channel
+			RRD, with as many timestamp:values arguments as were buffered.
+		'''
+		start_time = time.time()
+		self._flush_time = start_time
+
+		updates = []
+		for descriptor in self._descriptors.values():
+			if descriptor.pending:
+				updates.append((descriptor.rrd, descriptor.pending))
+				descriptor.pending = []
+
+		if not updates:
+			return
+
+		sent = False
+
+		if self._rrdcached and start_time >= self._rrdcached_retry:
+			commands = [ 'UPDATE {0} {1}'.format(ch_rrd, ' '.join(values)) for ch_rrd, values in updates ]
+
+			for attempt in range(2):
+				try:
+					errors = self._rrdcached.batch(commands)
+					sent = True
+
+					# errors are mostly updates too close together (see publish)
+					if errors:
+						self.batch_stats['errors'] += len(errors)
+						self._logger.debug("RRD batch errors: {0}".format(errors))
+					break
+
+				except (OSError, ValueError) as e:
+					self._rrdcached.close()
+					self.batch_stats['reconnects'] += 1
+					self._logger.error("RRD batch to rrdcached failed: {0}".format(e))
+
+			if not sent:
+				self.batch_stats['fallbacks'] += 1
+				self._rrdcached_retry = start_time + RRDCACHED_RETRY_s
+
+		if not sent:
+			# direct file updates
+			for ch_rrd, values in updates:
+				try:
+					rrdtool.update(os.path.join(CHDIR, ch_rrd), *values, '--skip-past-updates')
+
+				except:
+					self.batch_stats['errors'] += 1
+					self._logger.error(sys.exc_info()[1])
+
+		batch_s = time.time() - start_time
+
+		self.batch_stats['batches'] += 1
+		self.batch_stats['channels'] += len(updates)
+		self.batch_stats['samples'] += sum([ len(values) for ch_rrd, values in updates ])
+		self.batch_stats['last_batch_s'] = batch_s
+		self.batch_stats['max_batch_s'] = max(self.batch_stats['max_batch_s'], batch_s)
+
+
+	def close(self):
+		self.flush()
+
+		if self._rrdcached:
+			self._rrdcached.close()
+
+
+	def _descriptor(self, channel, now):
+		''' Returns the channel's publish descriptor, preparing the channel
+			RRD only if it's not cached (or the cached one went stale).
+		'''
+		self._checkResets(now)
+
+		descriptor = self._descriptors.get(channel.id)
+
+		if descriptor is None or not descriptor.matches(channel):
+			if descriptor is not None and descriptor.pending:
+				self.flush() # buffered samples go to the RRD they were made for
+
+			ch_rrd, sorted_sensors = self._prepare(channel)
+			descriptor = _RrdDescriptor(channel, ch_rrd, sorted_sensors)
+			self._descriptors[channel.id] = descriptor
+
+		return descriptor
+
+
+	def _checkResets(self, now):
+		''' Every RRD_RESCAN_s, drops the descriptors of channels that have
+			a reset file or lost their RRD.  The per-channel checks are only
+			done if CHDIR has changed (i.e., files were added or removed).
+		'''
+		if now < self._rescan_time:
+			return
+
+		self._rescan_time = now + RRD_RESCAN_s
+
+		try:
+			mtime = os.stat(CHDIR).st_mtime_ns
+		except OSError:
+			mtime = None
+
+		if mtime == self._chdir_mtime:
+			return
+
+		self._chdir_mtime = mtime
+
+		stale = [ ch_id for ch_id, descriptor in self._descriptors.items() if descriptor.stale() ]
+
+		# write out the buffered samples of the stale descriptors first
+		if any([ self._descriptors[ch_id].pending for ch_id in stale ]):
+			self.flush()
+
+		for ch_id in stale:
+			del self._descriptors[ch_id]
+
+
+	def _prepare(self, channel):
+		''' Finds (or creates) the channel RRD.  Returns the RRD filename and
+			the channel sensors in DS order.
+		'''
 		# Use glob to find existing RRD for chX (this might result in None)
 		ch_rrd = glob.glob(os.path.join(CHDIR, channel.id + '_*.rrd'))
 
@@ -241,29 +580,11 @@ class RRD():
 			# list of str.  Loading configs from file that make their way here can
 			# result in unicode items. See http://stackoverflow.com/q/956867.
 			ds_and_rra = [ str(s) for s in (DS + RRA) ]
-			_rrdcreate(ch_rrd, '--step', '1', *ds_and_rra )
+			_rrdcreate(ch_rrd, '--step', str(RRD_STEP_s), *ds_and_rra )
 			self._logger.info("RRD {0} created".format(os.path.basename(ch_rrd)))
 
 		else:
 			# ensure ch_rrd is a filename only at this point
 			ch_rrd = os.path.basename(ch_rrd)
 
-		# Create the update argument for the channel's RRD
-		# These have to go in order of the channel's sensor DS's (s0_, s1_, ...)
-		UPDATE = []
-
-		# Sensors must be updated in the same order as well
-		DATA_UPDATE = 'N:' + ':'.join([ '{:f}'.format(s.values[0][1]) for s in sorted_sensors ])
-
-		#self._logger.debug("RRD update: " + DATA_UPDATE) 
-
-		# try/catch to watch out for updates that occur too often.  Here we just
-		# log and ignore the exception (for now).  This may just be related to
-		# an issue with the RRDCacheD and floating point rounding errors.
-		# (JJB) NOTE: Rrdtool has a command switch to silently ignore these errors
-		# which I've turned on as the errors were filling up the syslog.
-		try:
-			_rrdupdate(ch_rrd, DATA_UPDATE)
-
-		except:
-			self._logger.error(sys.exc_info()[1])
+		return ch_rrd, sorted_sensors
@@ -1,7 +1,5 @@
 
-import logging
-import crcmod.predefined
-import struct
+import logging, threading
 
 DSPCR1_REGADDR  = 0x00
 DSPCR2_REGADDR  = 0x02
@@ -97,6 +95,44 @@ def calcMask(width, position):
 	return ((2 ** width) - 1) << position
 
 
+def _crc8Table(poly):
+	table = bytearray(256)
+	for i in range(256):
+		crc = i
+		for bit in range(8):
+			crc = ((crc << 1) ^ poly) if crc & 0x80 else (crc << 1)
+		table[i] = crc & 0xFF
+	return bytes(table)
+
+# CRC-8 lookup table (polynomial x^8 + x^2 + x + 1, init 0x00 - same as
+# the crcmod predefined 'crc-8' used by the STPM3X frame CRC)
+CRC8_TABLE = _crc8Table(0x07)
+
+
+def calcCrc8(data):
+	''' Returns the CRC-8 of data (bytes, bytearray or list of ints)
+	'''
+	crc = 0
+	for b in data:
+		crc = CRC8_TABLE[crc ^ b]
+	return crc
+
+
+def checkCrc8(frame):
+	''' True if the 5th byte of an STPM3X frame is the CRC-8 of the first 4
+	'''
+	table = CRC8_TABLE
+	return table[table[table[table[frame[0]] ^ frame[1]] ^ frame[2]] ^ frame[3]] == frame[4]
+
+
+def checkCrc8Frames(frames):
+	''' Validates a burst of STPM3X frames.  Returns a list of True/False
+		for each frame.
+	'''
+	table = CRC8_TABLE
+	return [ table[table[table[table[f[0]] ^ f[1]] ^ f[2]] ^ f[3]] == f[4] for f in frames ]
+
+
 class STPM3X:
 
 
@@ -285,11 +321,23 @@ class Stpm3x(object):
 	_spiHandle = 0
 	_logger = None
 
-	def __init__(self, spiHandle, config):
+	def __init__(self, spiHandle, config, spiLock=None):
 		self.error = '' # empty for no errors
 
 		self._spiHandle = spiHandle
 
+		# Serializes transactions with other users of the SPI bus
+		# (the register read pipeline must not be interleaved)
+		self._spiLock = spiLock or threading.RLock()
+
+		# Register snapshot - register values read during a tick
+		# are cached here so that sensors sharing a register address
+		# read the device only once per tick (see readMany).
+		self._snapshot = {}
+		self._snapshot_tick = None
+		self.snapshot_hits = 0
+		self.snapshot_misses = 0
+
 		# config passed is a subset of the STPM3X configuration
 		# use the Config class to get the default values of items NOT passed in:
 		config = Config(config)
@@ -342,26 +390,16 @@ class Stpm3x(object):
 		result += data_bytes[0] << 24
 		return result
 
-	def _crc8_calc(self,data):
-		crc8_func = crcmod.predefined.mkCrcFun('crc-8')
-		hex_bytestring = struct.pack('>I',data)
-		crc = crc8_func(hex_bytestring)
-		return crc
-
 	def _check_crc(self,data):
-		packet = self._bytes2int32(data[0:4])
-		crc = self._crc8_calc(packet)
-		if (crc == data[4]):
-			return True
-		else:
-			return False
+		return checkCrc8(data)
 
 	def _readRegister(self, addr):
 		validData = False
 		attempts = 0
 		while((validData == False) and (attempts < 5)):
-			self._spiHandle.xfer2([addr, 0xFF, 0xFF, 0xFF, 0xFF])
-			readbytes = self._spiHandle.xfer2([0xFF, 0xFF, 0xFF, 0xFF, 0xFF])
+			with self._spiLock:
+				self._spiHandle.xfer2([addr, 0xFF, 0xFF, 0xFF, 0xFF])
+				readbytes = self._spiHandle.xfer2([0xFF, 0xFF, 0xFF, 0xFF, 0xFF])
 			#print readbytes
 			validData = self._check_crc(readbytes)
 			#print validData
@@ -371,6 +409,38 @@ class Stpm3x(object):
 		#self.printRegister(val)
 		return val
 
+	def _readRegisters(self, addresses):
+		''' Pipelined read of several register addresses.  The STPM3X
+			returns the register requested in the previous frame, so each
+			frame carries the next read address and N registers take N + 1
+			transfers instead of 2 * N.  Frames that fail the CRC check are
+			re-read individually.  Returns a dict of address -> value.
+		'''
+		values = {}
+
+		if not addresses:
+			return values
+
+		with self._spiLock:
+			# prime the pipeline with the first address; its response is
+			# whatever the device had latched and is discarded
+			self._spiHandle.xfer2([addresses[0], 0xFF, 0xFF, 0xFF, 0xFF])
+
+			frames = []
+			for i, addr in enumerate(addresses):
+				next_addr = addresses[i + 1] if i + 1 < len(addresses) else 0xFF
+				frames.append(self._spiHandle.xfer2([next_addr, 0xFF, 0xFF, 0xFF, 0xFF]))
+
+		for addr, readbytes, valid in zip(addresses, frames, checkCrc8Frames(frames)):
+			values[addr] = self._bytes2int32_rev(readbytes[0:4]) if valid else None
+
+		# retry the frames that failed CRC one at a time
+		for addr, val in values.items():
+			if val is None:
+				values[addr] = self._readRegister(addr)
+
+		return values
+
 	def _writeRegister(self, address, data):
 		upperMSB = (data >> 24) & 0xFF
 		upperLSB = (data >> 16) & 0xFF
@@ -382,15 +452,14 @@ class Stpm3x(object):
 		#print '0x{:02x}'.format(lowerMSB)
 		#print '0x{:02x}'.format(lowerLSB)
 
-		#Generate packet for upper portion of register
-		packet = self._bytes2int32([0x00, address+1, upperLSB, upperMSB])
-		crc = self._crc8_calc(packet)
-		self._spiHandle.xfer2([0x00, address+1, upperLSB, upperMSB, crc])
+		with self._spiLock:
+			#Generate packet for upper portion of register
+			packet = [0x00, address+1, upperLSB, upperMSB]
+			self._spiHandle.xfer2(packet + [ calcCrc8(packet) ])
 
-		#Generate packet for lower portion of register
-		packet = self._bytes2int32([0x00, address, lowerLSB, lowerMSB])
-		crc = self._crc8_calc(packet)
-		self._spiHandle.xfer2([0x00, address, lowerLSB, lowerMSB, crc])
+			#Generate packet for lower portion of register
+			packet = [0x00, address, lowerLSB, lowerMSB]
+			self._spiHandle.xfer2(packet + [ calcCrc8(packet) ])
 
 		#Read back register
 		return self._readRegister(address)
@@ -453,6 +522,57 @@ class Stpm3x(object):
 		regValue = self._readRegister(register['address'])
 		#print("Register Value: " + hex(regValue))
 
+		return self._decode(regValue, register, threshold)
+
+	def readMany(self, registers, tick=None):
+		''' Returns the values of several registers from a single pipelined
+			burst.  Pass a list of (register name, threshold) pairs; the
+			values are returned in the same order.  Registers sharing an
+			address (e.g., V1RMS and C1RMS in DSPREG14) are read only once.
+
+			If a tick is given, register values are served from (and added
+			to) the device's register snapshot for that tick.  A new tick
+			invalidates the snapshot.
+		'''
+		registers = [ (STPM3X.__dict__[name], threshold) for name, threshold in registers ]
+
+		if tick is not None and tick != self._snapshot_tick:
+			self.invalidateSnapshot(tick)
+
+		# de-duplicate by address, keeping the request order
+		addresses = []
+		for register, threshold in registers:
+			if not register['address'] in addresses:
+				addresses.append(register['address'])
+
+		if tick is None:
+			regValues = self._readRegisters(addresses)
+
+		else:
+			missing = [ addr for addr in addresses if not addr in self._snapshot ]
+			self.snapshot_hits += len(addresses) - len(missing)
+			self.snapshot_misses += len(missing)
+
+			self._snapshot.update(self._readRegisters(missing))
+			regValues = self._snapshot
+
+		return [ self._decode(regValues[register['address']], register, threshold) for register, threshold in registers ]
+
+	def invalidateSnapshot(self, tick=None):
+		''' Drops the register snapshot.  Subsequent reads for the given
+			tick go to the device again.
+		'''
+		self._snapshot = {}
+		self._snapshot_tick = tick
+
+	def snapshotStats(self):
+		''' Returns the register snapshot hit/miss counters.
+		'''
+		return { 'hits': self.snapshot_hits, 'misses': self.snapshot_misses, 'size': len(self._snapshot) }
+
+	def _decode(self, regValue, register, threshold=None):
+		''' Extracts a register field from the raw 32-bit register value.
+		'''
 		#get value from register, mask and shift
 		maskedValue = (regValue & register['mask']) >> register['position']
 		#print("Masked Value:   " + hex(maskedValue))
@@ -0,0 +1,109 @@
+# Sensor sample ring buffer
+#
+# Keeps the last N (tick, value) samples of a sensor in two parallel
+# preallocated columns, so pushing a sample is two stores and an index
+# update (no allocation).  The hot paths read the newest sample with
+# latestTick() / latestValue(), which don't allocate either.  Indexing
+# and iteration work like the deque of [ tick, value ] lists it replaces
+# (newest first, values[0] is the latest sample, None for the slots not
+# filled yet), and last() / since() return chronological array('d')
+# copies for windowed processing.
+
+from array import array
+
+_NAN = float('nan')
+
+
+class SampleBuffer():
+
+	__slots__ = ('_ticks', '_values', '_size', '_head')
+
+	def __init__(self, size):
+		self._ticks = [ None ] * size # None: not filled yet
+		self._values = [ None ] * size
+		self._size = size
+		self._head = size - 1 # index of the newest sample
+
+	def push(self, tick, value):
+		head = self._head + 1
+		if head == self._size:
+			head = 0
+
+		self._ticks[head] = tick
+		self._values[head] = value
+		self._head = head
+
+	def latestTick(self):
+		''' Tick of the newest sample (None if empty) '''
+		return self._ticks[self._head]
+
+	def latestValue(self):
+		''' Value of the newest sample (None if empty or not read) '''
+		return self._values[self._head]
+
+	def latest(self):
+		''' ( tick, value ) of the newest sample, or None '''
+		head = self._head
+		if self._ticks[head] is None:
+			return None
+
+		return self._ticks[head], self._values[head]
+
+	def __len__(self):
+		# like the pre-filled deque, the buffer always has size entries
+		return self._size
+
+	def __getitem__(self, i):
+		''' [ tick, value ] of the i-th newest sample (None if not filled) '''
+		if i < 0:
+			i += self._size
+		if i < 0 or i >= self._size:
+			raise IndexError("sample index out of range")
+
+		j = self._head - i
+		if j < 0:
+			j += self._size
+
+		tick = self._ticks[j]
+		return None if tick is None else [ tick, self._values[j] ]
+
+	def __iter__(self):
+		for i in range(self._size):
+			yield self[i]
+
+	def _count(self):
+		# samples pushed (up to size) - the columns fill from index 0
+		if self._ticks[-1] is not None:
+			return self._size
+
+		return self._head + 1 if self._ticks[self._head] is not None else 0
+
+	def last(self, n):
+		''' ( ticks, values ) arrays of the newest n samples, oldest first
+			(missing values are NaN)
+		'''
+		n = min(n, self._count())
+		start = self._head - n + 1
+
+		if start >= 0:
+			ticks = self._ticks[start:self._head + 1]
+			values = self._values[start:self._head + 1]
+		else:
+			# wrapped around the end of the columns
+			start += self._size
+			ticks = self._ticks[start:] + self._ticks[:self._head + 1]
+			values = self._values[start:] + self._values[:self._head + 1]
+
+		return array('d', ticks), array('d', [ _NAN if v is None else v for v in values ])
+
+	def since(self, tick):
+		''' ( ticks, values ) arrays of the samples at or after tick '''
+		count = self._count()
+		n = 0
+		j = self._head
+
+		while n < count and self._ticks[j] >= tick:
+			n += 1
+			j = j - 1 if j else self._size - 1
+
+		return self.last(n)
@@ -0,0 +1,142 @@
+# Fixed-period loop scheduling
+#
+# The hardware loop runs on absolute deadlines (start + n * period) on the
+# monotonic clock, so the work done in each period doesn't add up to drift
+# against the wall clock.  When an iteration overruns its period the
+# policy decides what happens to the missed deadlines:
+#
+#	SKIP		run once right away and drop the periods that were missed
+#				entirely (counted as skipped)
+#	CATCHUP		run the missed periods back-to-back until caught up (up
+#				to LOOP_CATCHUP_MAX periods, then resync as for SKIP)
+#
+# Wake-up jitter (how late the loop woke relative to its deadline) is kept
+# in a histogram and logged every LOOP_REPORT_s with the overrun counts and
+# the timing of the loop stages (alarms, read, sync, publish, thresholds, ...).
+
+import time, logging
+
+from contextlib import contextmanager
+
+LOOP_OVERRUN_POLICY = 'SKIP' # 'SKIP' | 'CATCHUP'
+LOOP_CATCHUP_MAX = 5
+LOOP_REPORT_s = 60
+
+# upper bounds (ms) of the jitter histogram bins (last bin is open)
+JITTER_BINS_ms = [ 0.1, 0.5, 1, 2, 5, 10, 50 ]
+
+
+class LoopScheduler():
+
+	def __init__(self, period_s, policy=LOOP_OVERRUN_POLICY, report_s=LOOP_REPORT_s):
+		self._logger = logging.getLogger(__name__)
+
+		if policy not in ('SKIP', 'CATCHUP'):
+			raise ValueError("Unknown loop overrun policy {0}".format(policy))
+
+		self.period_s = period_s
+		self.policy = policy
+		self.report_s = report_s
+
+		self._deadline = None
+		self._report_time = None
+
+		self._reset()
+
+	def _reset(self):
+		self.periods = 0
+		self.overruns = 0
+		self.skipped = 0
+		self.jitter = [ 0 for b in range(len(JITTER_BINS_ms) + 1) ]
+		self.max_jitter_s = 0
+
+		# stage name: [ count, total seconds, max seconds ]
+		self.stages = {}
+
+	def wait(self):
+		''' Sleeps until the start of the next period.  Call at the top of
+			each loop iteration (the first call starts the schedule).
+		'''
+		now = time.monotonic()
+
+		if self._deadline is None:
+			self._deadline = now
+			self._report_time = now + self.report_s
+			return
+
+		self._deadline += self.period_s
+
+		if now > self._deadline:
+			# the last iteration overran its period
+			self.overruns += 1
+
+			behind = int((now - self._deadline) / self.period_s)
+
+			if behind and (self.policy == 'SKIP' or behind > LOOP_CATCHUP_MAX):
+				self._deadline += behind * self.period_s
+				self.skipped += behind
+
+		delay = self._deadline - now
+		if delay > 0:
+			time.sleep(delay)
+
+			# jitter only counts for deadlines we slept until
+			late_s = max(0, time.monotonic() - self._deadline)
+			late_ms = late_s * 1000
+			b = 0
+			while b < len(JITTER_BINS_ms) and late_ms >= JITTER_BINS_ms[b]:
+				b += 1
+			self.jitter[b] += 1
+			self.max_jitter_s = max(self.max_jitter_s, late_s)
+
+		self.periods += 1
+
+		if self._deadline >= self._report_time:
+			self._report_time = self._deadline + self.report_s
+			self.report()
+
+	def record(self, stage, seconds):
+		''' Adds a stage timing measured elsewhere '''
+		s = self.stages.get(stage)
+
+		if s is None:
+			self.stages[stage] = [ 1, seconds, seconds ]
+		else:
+			s[0] += 1
+			s[1] += seconds
+			s[2] = max(s[2], seconds)
+
+	@contextmanager
+	def stage(self, stage):
+		''' Times the enclosed block as a loop stage '''
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.record(stage, time.monotonic() - start)
+
+	def stats(self):
+		bins = [ '<{0}'.format(b) for b in JITTER_BINS_ms ] + [ '>={0}'.format(JITTER_BINS_ms[-1]) ]
+
+		return {
+			'periods': self.periods,
+			'overruns': self.overruns,
+			'skipped': self.skipped,
+			'jitter_ms': dict(zip(bins, self.jitter)),
+			'max_jitter_ms': 1000 * self.max_jitter_s,
+			'stages_ms': { name: { 'avg': 1000 * s[1] / s[0], 'max': 1000 * s[2] } for name, s in self.stages.items() }
+		}
+
+	def report(self):
+		''' Logs the stats since the last report and starts over '''
+		stats = self.stats()
+
+		self._logger.info("Loop {0:.3f} s ({1}): {2} periods, {3} overruns, {4} skipped, max jitter {5:.3f} ms".format(
+			self.period_s, self.policy, stats['periods'], stats['overruns'], stats['skipped'], stats['max_jitter_ms']))
+
+		self._logger.info("\tjitter ms: {0}".format(", ".join([ "{0}: {1}".format(k, v) for k, v in stats['jitter_ms'].items() ])))
+
+		for name, s in stats['stages_ms'].items():
+			self._logger.info("\t{0:<8} avg {1:8.3f} ms, max {2:8.3f} ms".format(name, s['avg'], s['max']))
+
+		self._reset()
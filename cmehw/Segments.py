@@ -0,0 +1,356 @@
+# Columnar segment store
+#
+# An append-only time-series store that keeps every published sample
+# (no fixed-step consolidation like the RRDs).  Each channel has a folder
+# of segment files, one per hour (or less, see below), named by the
+# timestamp of the first sample and a sequence number (segments started
+# in the same millisecond, e.g. across a restart, don't overwrite each
+# other):
+#
+#	<SEGDIR>/chX/<start_ms>_<n>.seg
+#
+# A segment is a fixed-size, memory-mapped file:
+#
+#	header		magic, version, sensor count, start_ms, capacity, row count
+#	sensor ids	length (uint8) + utf-8 bytes each
+#	ts_ms		int64[capacity]
+#	<sensor>	float32[capacity] - one column per sensor
+#
+# All values are little-endian.  Rows are appended in timestamp order and
+# the row count is updated after the row is written, so readers (e.g., the
+# API layer in another process) only see complete rows.  A new segment is
+# started every hour, when a segment is full or when the channel's sensors
+# change.  Missing sensor values are stored as NaN.
+
+import os, sys, time, logging, mmap, struct
+
+from array import array
+from bisect import bisect_left
+
+from .common import Config
+
+from .Sink import Sink
+
+# Segment files are kept under CHDIR
+SEGDIR = os.path.join(Config.PATHS.CHDIR, 'segments')
+
+# segment duration and row capacity (one hour at up to 10 samples/s)
+SEGMENT_ms = 3600 * 1000
+SEGMENT_ROWS = 3600 * 10
+
+SEGMENT_MAGIC = b'CMES'
+SEGMENT_VERSION = 2
+
+# magic, version, (reserved), sensor count, start_ms, capacity, row count
+SEGMENT_HEADER = struct.Struct('<4sBBHqII')
+SEGMENT_COUNT = struct.Struct('<I')
+SEGMENT_COUNT_OFFSET = SEGMENT_HEADER.size - SEGMENT_COUNT.size
+
+# sensor ids are length-prefixed (version 1 used fixed 8-byte ids)
+SENSOR_ID_LENGTH = struct.Struct('<B')
+SENSOR_ID_MAX = 255
+SENSOR_ID_SIZE_V1 = 8
+
+_TS = struct.Struct('<q')
+_VALUE = struct.Struct('<f')
+
+
+def _dataOffset(ids_size):
+	# columns start 8-byte aligned after the header and sensor ids
+	offset = SEGMENT_HEADER.size + ids_size
+	return (offset + 7) & ~7
+
+def _segmentSize(ids_size, sensor_count, capacity):
+	return _dataOffset(ids_size) + 8 * capacity + 4 * capacity * sensor_count
+
+def _encodeSensors(sensors):
+	''' The sensor ids as written to the segment header '''
+	ids = []
+	for sId in sensors:
+		encoded = sId.encode()
+		if len(encoded) > SENSOR_ID_MAX:
+			raise ValueError("Sensor id too long for a segment: {0}".format(sId))
+		ids.append(SENSOR_ID_LENGTH.pack(len(encoded)) + encoded)
+	return b''.join(ids)
+
+def _segmentName(name):
+	''' ( start_ms, sequence ) of a segment file name, None if not a segment '''
+	if not name.endswith('.seg'):
+		return None
+	start, _, seq = name[:-len('.seg')].partition('_') # <start_ms>.seg before version 2
+	try:
+		return int(start), int(seq or 0)
+	except ValueError:
+		return None
+
+def _column(mm, offset, typecode, start, end):
+	# array of rows start..end-1 of the column at offset
+	size = array(typecode).itemsize
+	values = array(typecode)
+	values.frombytes(mm[offset + size * start:offset + size * end])
+	if sys.byteorder == 'big':
+		values.byteswap()
+	return values
+
+
+class _TsColumn():
+	''' The ts_ms column as a sequence (for bisect) without copying it '''
+
+	def __init__(self, segment, rows):
+		self._segment = segment
+		self._rows = rows
+
+	def __len__(self):
+		return self._rows
+
+	def __getitem__(self, row):
+		return self._segment.ts(row)
+
+
+class _Segment():
+	''' One memory-mapped segment file '''
+
+	def __init__(self, path, writable=False):
+		self.path = path
+
+		with open(path, 'r+b' if writable else 'rb') as f:
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+		magic, version, reserved, sensor_count, self.start_ms, self.capacity, count = SEGMENT_HEADER.unpack_from(self._mm)
+
+		if magic != SEGMENT_MAGIC or version not in (1, SEGMENT_VERSION) or (writable and version != SEGMENT_VERSION):
+			self._mm.close()
+			raise ValueError("Unknown segment format {0}".format(path))
+
+		self.sensors = []
+		offset = SEGMENT_HEADER.size
+		for i in range(sensor_count):
+			if version == 1:
+				size = SENSOR_ID_SIZE_V1
+				self.sensors.append(self._mm[offset:offset + size].rstrip(b'\0').decode())
+			else:
+				size = SENSOR_ID_LENGTH.unpack_from(self._mm, offset)[0]
+				offset += SENSOR_ID_LENGTH.size
+				self.sensors.append(self._mm[offset:offset + size].decode())
+			offset += size
+
+		self._ts_offset = _dataOffset(offset - SEGMENT_HEADER.size)
+		self._offsets = [ self._ts_offset + 8 * self.capacity + 4 * self.capacity * i for i in range(sensor_count) ]
+
+		# rows written (by this process - readers use rows())
+		self.count = count
+
+	@classmethod
+	def create(cls, ch_path, sensors, start_ms, capacity):
+		''' Creates a new segment in the channel folder - never overwrites
+			an existing one (the sequence number is bumped instead).
+		'''
+		ids = _encodeSensors(sensors)
+		size = _segmentSize(len(ids), len(sensors), capacity)
+
+		seq = 0
+		while True:
+			path = os.path.join(ch_path, '{0}_{1}.seg'.format(start_ms, seq))
+			try:
+				f = open(path, 'xb')
+				break
+			except FileExistsError:
+				seq += 1
+
+		with f:
+			f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, 0, len(sensors), start_ms, capacity, 0))
+			f.write(ids)
+			f.truncate(size) # sparse until written
+
+		return cls(path, writable=True)
+
+	def close(self):
+		self._mm.close()
+
+	def flush(self):
+		self._mm.flush()
+
+	def rows(self):
+		''' Current row count from the header '''
+		return SEGMENT_COUNT.unpack_from(self._mm, SEGMENT_COUNT_OFFSET)[0]
+
+	def full(self):
+		return self.count >= self.capacity
+
+	def ts(self, row):
+		return _TS.unpack_from(self._mm, self._ts_offset + 8 * row)[0]
+
+	def append(self, ts_ms, values):
+		''' Append a row - values are in sensor column order '''
+		row = self.count
+
+		_TS.pack_into(self._mm, self._ts_offset + 8 * row, ts_ms)
+		for offset, value in zip(self._offsets, values):
+			_VALUE.pack_into(self._mm, offset + 4 * row, value)
+
+		self.count = row + 1
+		SEGMENT_COUNT.pack_into(self._mm, SEGMENT_COUNT_OFFSET, self.count)
+
+	def read(self, start_ms, end_ms):
+		''' Returns { 'ts_ms': array('q'), <sensor id>: array('f'), ... }
+			for the rows with start_ms <= ts_ms < end_ms.
+		'''
+		ts = _TsColumn(self, self.rows())
+
+		start = bisect_left(ts, start_ms)
+		end = bisect_left(ts, end_ms, start)
+
+		data = { 'ts_ms': _column(self._mm, self._ts_offset, 'q', start, end) }
+		for sId, offset in zip(self.sensors, self._offsets):
+			data[sId] = _column(self._mm, offset, 'f', start, end)
+
+		return data
+
+
+
+def readSegments(channel_id, start_ms, end_ms, path=SEGDIR):
+	''' Range read of a channel's samples with start_ms <= ts_ms < end_ms.
+		Returns a list of { 'ts_ms': array('q'), <sensor id>: array('f'), ... }
+		(one per segment, as the sensors can differ between segments).
+	'''
+	ch_path = os.path.join(path, channel_id)
+
+	try:
+		names = [ (_segmentName(f), f) for f in os.listdir(ch_path) ]
+	except OSError:
+		return []
+
+	names = sorted([ (key, f) for key, f in names if key is not None ])
+	starts = [ key[0] for key, f in names ]
+
+	results = []
+	for i, (key, name) in enumerate(names):
+		# a segment covers up to the start of the next one (which can
+		# start in the same millisecond as its last row)
+		if starts[i] >= end_ms:
+			break
+		if i + 1 < len(starts) and starts[i + 1] < start_ms:
+			continue
+
+		segment = _Segment(os.path.join(ch_path, name))
+		try:
+			data = segment.read(start_ms, end_ms)
+		finally:
+			segment.close()
+
+		if len(data['ts_ms']):
+			results.append(data)
+
+	return results
+
+
+
+class SegmentStore(Sink):
+	''' Publishes channel samples to the columnar segment store '''
+
+	def __init__(self, path=SEGDIR):
+		self._logger = logging.getLogger(__name__)
+		self._path = path
+
+		# open (writable) segment by channel id
+		self._segments = {}
+
+		# ( sensors dict, sensor count, sensors in column order ) by channel id
+		self._columns = {}
+
+		# last stored sample time by channel id
+		self._last_ms = {}
+
+		self.stats = {
+			'rows': 0,
+			'segments': 0,
+			'skipped': 0,
+			'last_publish_s': 0,
+			'max_publish_s': 0
+		}
+
+		os.makedirs(path, exist_ok=True)
+		self._logger.info("Segment store in {0}".format(path))
+
+	def publishBatch(self, channels):
+		start_time = time.time()
+
+		for channel in channels:
+			if channel.error or channel.stale:
+				continue
+
+			sorted_sensors = self._sortedSensors(channel)
+			if not sorted_sensors:
+				continue
+
+			# newest sample time (sensors can be read at different rates)
+			ticks = [ s.values.latestTick() for s in sorted_sensors ]
+			if None in ticks:
+				continue # not all sensors read yet
+
+			tick = max(ticks)
+
+			ts_ms = int(round(tick * 1000))
+
+			# only new samples (the channel may not have been read again)
+			if ts_ms <= self._last_ms.get(channel.id, 0):
+				self.stats['skipped'] += 1
+				continue
+
+			self._last_ms[channel.id] = ts_ms
+			segment = self._segment(channel.id, [ s.id for s in sorted_sensors ], ts_ms)
+
+			values = [ s.values.latestValue() for s in sorted_sensors ]
+			segment.append(ts_ms, [ float('nan') if v is None else v for v in values ])
+			self.stats['rows'] += 1
+
+		publish_s = time.time() - start_time
+		self.stats['last_publish_s'] = publish_s
+		self.stats['max_publish_s'] = max(self.stats['max_publish_s'], publish_s)
+
+	def _sortedSensors(self, channel):
+		''' Channel sensors by id - only re-sorted if the sensors changed '''
+		columns = self._columns.get(channel.id)
+
+		if columns is None or columns[0] is not channel.sensors or columns[1] != len(channel.sensors):
+			columns = (channel.sensors, len(channel.sensors), sorted(channel.sensors.values(), key = lambda s: s.id))
+			self._columns[channel.id] = columns
+
+		return columns[2]
+
+	def _segment(self, channel_id, sensors, ts_ms):
+		''' Returns the channel's segment for the sample, starting a new
+			segment on the hour, when full or when the sensors change.
+		'''
+		segment = self._segments.get(channel_id)
+
+		if segment and segment.sensors == sensors and not segment.full() and \
+				ts_ms // SEGMENT_ms == segment.start_ms // SEGMENT_ms:
+			return segment
+
+		if segment:
+			segment.close()
+
+		ch_path = os.path.join(self._path, channel_id)
+		os.makedirs(ch_path, exist_ok=True)
+
+		segment = _Segment.create(ch_path, sensors, ts_ms, SEGMENT_ROWS)
+		self._segments[channel_id] = segment
+		self.stats['segments'] += 1
+
+		self._logger.info("Segment {0} started".format(segment.path))
+		return segment
+
+	def read(self, channel_id, start_ms, end_ms):
+		return readSegments(channel_id, start_ms, end_ms, self._path)
+
+	def flush(self):
+		for segment in self._segments.values():
+			segment.flush()
+
+	def close(self):
+		for segment in self._segments.values():
+			segment.flush()
+			segment.close()
+
+		self._segments = {}
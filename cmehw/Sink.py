@@ -0,0 +1,25 @@
+# Channel data sinks
+#
+# main() publishes the channels to every configured sink after each
+# updateChannels().  The RRD is one sink, the Segments store is another.
+
+from abc import ABC, abstractmethod
+
+
+class Sink(ABC):
+	''' Base class of the channel data sinks.
+	'''
+
+	@abstractmethod
+	def publishBatch(self, channels):
+		''' Publish the latest data of the channels (error and stale
+			channels are skipped).
+		'''
+
+	def flush(self):
+		''' Write out any buffered data '''
+		pass
+
+	def close(self):
+		''' Flush and release the sink's resources '''
+		self.flush()
@@ -2,14 +2,25 @@
 #
 # Works with hardware channels to save alarms if current channel values are not within nominal
 # region defined by channel threshold configuration
+#
+# Sensor thresholds are configured in the channel config file:
+#
+#	"sensors": [ { "id": "s0", "thresholds": [ {
+#		"value": 130,				threshold value
+#		"direction": "MAX",			"MAX" (alarm above value) or "MIN" (alarm below)
+#		"classification": "ALARM",	alarm history name
+#		"hysteresis": 2,			out of alarm once back past value by this much (default 0)
+#		"onDelay": 3,				ticks in alarm before the alarm opens (default 0)
+#		"offDelay": 5				ticks out of alarm before the alarm closes (default ALARM_LEAD_POINTS)
+#	}, ... ] }, ... ]
 
-import os, logging, json, time, tempfile
-
-from random import randint
+import os, logging, json, time
 
 from .common import Config
 from .common.Switch import switch
-from .common.LockedOpen import LockedOpen
+
+from .AlarmJournal import AlarmJournal, AlarmFlusher
+from .AlarmHistory import AlarmHistory
 
 # The location where channel data and configuration are stored (typically /data/channels/)
 CHDIR = Config.PATHS.CHDIR
@@ -17,19 +28,58 @@ CHDIR = Config.PATHS.CHDIR
 MAX_ALARM_POINTS = Config.HARDWARE.MAX_ALARM_POINTS # how many points collected while in alarm condition
 ALARM_LEAD_POINTS = Config.HARDWARE.ALARM_LEAD_POINTS # how many pre- and post- alarm points are saved
 
+# Bounds of each sensor threshold classification alarm history - the
+# oldest alarm segments are dropped beyond these (see AlarmHistory.py)
+ALARM_HISTORY_MAX_POINTS = 10000
+ALARM_HISTORY_MAX_SEGMENTS = 500
+ALARM_HISTORY_MAX_AGE_s = 31 * 24 * 3600
+
+# Threshold directions
+MIN = 0 # alarm below the threshold value
+MAX = 1 # alarm above the threshold value
+
+DIRECTIONS = { 'MIN': MIN, 'MAX': MAX }
+
+# Threshold alarm states (see ProcessAlarms)
+IDLE = 0
+PENDING = 1
+ACTIVE = 2
+CLEARING = 3
+
+# What a threshold state update records (see _Threshold.update)
+_OPEN = 1
+_RECORD = 2
+_CLOSE = 3
+
 # Cache the channel configuration files so we
 # don't have to read from disk every time through.
 CONFIGS_CACHE = {}
 
+# The channel thresholds compiled from the cached
+# configuration - ( config, { sId: [ _Threshold ] } )
+THRESHOLDS_CACHE = {}
+
 # Cache alarms in memory and dump to disk only
 # every so often.  Can't be too long in between
 # updates, though, as the API layer will read
 # alarms from disk.
 ALARMS_CACHE = {}
 
-def ProcessAlarms(channel):
-	# TODO: We should probably bound the size of the alarm files.
+# Alarm history changes are journaled per channel (see AlarmJournal.py)
+ALARMS_JOURNALS = {}
+
+# Saves the alarm journals the main loop has no time for
+ALARMS_FLUSHER = None
+
+# Time per loop for threshold processing (ProcessAllAlarms) - once
+# used up, the channels' alarm saves go to ALARMS_FLUSHER
+ALARMS_BUDGET_s = 0.2 * Config.HARDWARE.LOOP_PERIOD_s
+
+# The channel config and alarms reset files are checked this often
+FILES_CHECK_s = 5
+FILES_CHECKED = {} # filename: next check time
 
+def ProcessAlarms(channel, save=True):
 	# Explanation:
 	#
 	# Alarms are processed on a per-channel basis.  Most of the sequence
@@ -50,28 +100,34 @@ def ProcessAlarms(channel):
 	#
 	# An alarm history is simply a list of points (which are just pairs of 
 	# time and value numbers) that were measured around threshold crossings.
+	# Histories are bounded (see ALARM_HISTORY_*), dropping the oldest
+	# alarm segments.
 	#
 	# To build up an alarm history each sensor's current value is compared
-	# against the configured thresholds. This results in either "alarm" 
-	# (sensor value exceeds threshold) or "no alarm" condition.
+	# against the configured thresholds.  Each threshold steps through the
+	# alarm states (see _Threshold.update) once per call:
 	#
-	# We record the sensor's point if "alarm" condition exists. BUT we don't want
-	# to just record everything.  So, we examine the sensor's alarm history (just for
-	# the particular threshold classification).
+	#	IDLE		not in alarm, no alarm record open
+	#	PENDING		in alarm for fewer than "onDelay" ticks
+	#	ACTIVE		in alarm, alarm record open
+	#	CLEARING	back out of alarm for fewer than "offDelay" ticks
 	#
-	# If there're no prior alarms OR if we're starting a new alarm segment (more on 
-	# that to follow), then we'll add the current point and all the sensor's
-	# buffered points to the alarms record.  This opens the alarm record.
+	# The value has to go past the threshold to be "in alarm", and back past
+	# it by the "hysteresis" band to be out of alarm again, so a noisy value
+	# near the threshold doesn't open and close lots of tiny alarm records.
 	#
-	# If there are prior alarms AND we're just tacking on another point, we first
-	# check to see how many points we've already been "in alarm".  We only record
-	# these alarm points for so long before we just skip them.  After that we'll
-	# resume recording them if the sensor value ever drops back out of alarm.
+	# Once ACTIVE we add the current point and all the sensor's buffered points
+	# to the alarms record.  This opens the alarm record.
 	#
-	# Finally, if the current sensor value is NOT in alarm, then we also check
-	# the alarm history.  We record a few points after dropping back out of alarm
-	# and then close the alarm record by sticking a null value (i.e., None) into
-	# the alarm points list.
+	# While ACTIVE we keep tacking on points, but we only record these alarm
+	# points for so long (MAX_ALARM_POINTS) before we just skip them.  After
+	# that we'll resume recording them if the sensor value ever drops back out
+	# of alarm.
+	#
+	# Finally, when CLEARING, we record a few points after dropping back out of
+	# alarm and then close the alarm record by sticking a null value (i.e., None)
+	# into the alarm points list.  Going back into alarm before then just
+	# continues the open record.
 
 	if channel.error or channel.stale:
 		#Logger.debug("Channel in alarm or stale - no alarms processed")
@@ -87,141 +143,333 @@ def ProcessAlarms(channel):
 		#Logger.debug("Channel alarm recording is OFF - no alarms processed")
 		return
 
-	# all sensors configs (where thresholds are stored)
-	sensor_configs = ch_config.get('sensors', None)
+	# the sensor thresholds compiled from the channel config
+	thresholds = _compileThresholds(channel.id, ch_config)
 
-	if not sensor_configs:
-		#self.Logger.debug("No sensors configured for channel {0}".format(channel.id))
+	if not thresholds:
+		#self.Logger.debug("No sensor thresholds configured for channel {0}".format(channel.id))
 		return 
 
 	# Load previous channel alarms from file; ch_alarms might be empty dict
 	ch_alarms = _loadAlarms(channel)
+	journal = ALARMS_JOURNALS[channel.id]
 
-	# check each channel sensor value against the thresholds
-	for sensor in channel.sensors:
-
-		# get our sensor config by sensor id
-		s_config = next((s for s in sensor_configs if s['id'] == sensor.id), None)
+	# check each channel sensor value against its thresholds
+	for sId, s_thresholds in thresholds.items():
 
-		if not s_config:
-			#Logger.debug("No sensor configuration found for channel {0}, sensor {1}".format(channel.id, sensor.id))
-			continue # no sensor config - skip this sensor
+		sensor = channel.sensors.get(sId)
+		if sensor is None:
+			continue # sensor not in this channel
 
-		thresholds = s_config.get('thresholds', [])
-		if not thresholds:
-			#Logger.debug("No thresholds found for channel {0}, sensor {1}".format(channel.id, sensor.id))
-			continue # no thresholds - skip this sensor
+		tick = sensor.values.latestTick()
+		value = sensor.values.latestValue()
+		if value is None:
+			continue # no current value
 
 		# get sensor alarms or set empty if none yet exist
-		s_alarms = ch_alarms.setdefault(sensor.id, {})
+		# (the alarms may be being saved on the flusher thread)
+		s_alarms = ch_alarms.get(sId)
+		if s_alarms is None:
+			with journal.lock:
+				s_alarms = ch_alarms[sId] = {}
+
+		for t in s_thresholds:
+
+			s_class_alarms = t.bind(s_alarms, journal)
+
+			#Logger.debug("Checking [{0}, {1}] for {2}...".format(tick, value, t.classification))
+
+			# the state steps once per sensor sample (sensors can be
+			# sampled less often than ProcessAlarms is called)
+			if tick == t.tick:
+				continue # no new sample
+			t.tick = tick
+
+			action = t.update(value)
+			if action is None:
+				continue # nothing to record
+
+			last = s_class_alarms.last()
+
+			if action == _OPEN and last is None:
+				# a new alarm segment - create new record w/all sensor
+				# buffer values (oldest first) not already in the history
+				prev = s_class_alarms.tail(2)
+				since = prev[0][0] if prev and prev[0] else None
+				points = [ [ x[0], x[1] ] for x in reversed(sensor.values) if x and x[1] is not None and (since is None or x[0] > since) ]
+
+			elif action == _CLOSE:
+				# Close alarm segment - unless a threshold with the
+				# same classification still has it open
+				if last is None or any(o is not t and o.history is s_class_alarms and o.state in (ACTIVE, CLEARING) for o in s_thresholds):
+					continue
+				points = [ None ]
+
+			elif last is not None and last[0] == tick:
+				continue # point already added for the classification
+
+			else:
+				points = [ [ tick, value ] ]
+
+			_addPoints(journal, sId, t.classification, s_class_alarms, points)
+
+	#Logger.debug("Done processing alarms:")
+	#Logger.debug("{0}".format(ch_alarms))
+	if save:
+		_saveAlarms(channel, ch_alarms)
+
+
+def ProcessAllAlarms(channels, budget_s=ALARMS_BUDGET_s):
+	''' Processes the alarms of all the channels (call once per loop).
+		The alarm histories are saved (when due) on the main loop while
+		within budget_s, and by ALARMS_FLUSHER after that.
+	'''
+	global ALARMS_FLUSHER
+
+	logger = logging.getLogger(__name__)
+
+	start_time = time.monotonic()
+
+	for channel in channels:
+		try:
+			ProcessAlarms(channel, save=False)
+
+			journal = ALARMS_JOURNALS.get(channel.id)
+			if not journal:
+				continue # not recording alarms
+
+			alarms = ALARMS_CACHE[channel.id]
+
+			# don't wait for the flusher if it's saving this channel
+			if time.monotonic() - start_time < budget_s and journal.save(alarms, blocking=False):
+				continue
+
+			if not ALARMS_FLUSHER:
+				ALARMS_FLUSHER = AlarmFlusher()
+				ALARMS_FLUSHER.start()
+
+			ALARMS_FLUSHER.submit(journal, alarms)
+
+		except Exception as e:
+			logger.error("{0} alarms processing failed: {1}".format(channel.id, e))
+
+
+def CloseAlarms():
+	''' Saves all the alarm histories (call at shutdown) '''
+	global ALARMS_FLUSHER
+
+	logger = logging.getLogger(__name__)
+
+	if ALARMS_FLUSHER:
+		ALARMS_FLUSHER.close()
+		logger.info("Alarms flusher: {0}".format(ALARMS_FLUSHER.stats()))
+		ALARMS_FLUSHER = None
+
+	for ch_id, journal in ALARMS_JOURNALS.items():
+		try:
+			journal.save(ALARMS_CACHE.get(ch_id, {}), force=True)
+
+		except Exception as e:
+			logger.error("{0} alarms save failed: {1}".format(ch_id, e))
 
-		# check sensor value against thresholds
-		for t in thresholds:
-			th_value = t.get('value', None)
-			direction = t.get('direction', None)
-			classification = t.get('classification', None)
 
-			s_value = sensor.values[0]
+def _addPoints(journal, sId, classification, class_alarms, points):
+	# add points to the sensor classification alarms and the journal
+	# (the history may be being saved on the flusher thread)
+	with journal.lock:
+		class_alarms.extend(points)
 
-			# get the alarms for this threshold by classification name
-			# if there isn't one, set an empty list as the default
-			s_class_alarms = s_alarms.setdefault(classification, [])
+		for p in points:
+			journal.append(sId, classification, p)
 
-			#Logger.debug("Checking [{0}, {1}] for {2}...".format(s_value[0], s_value[1], classification))
 
-			# determine alarm state True or False
-			alarm = _checkAlarm(s_value[1], th_value, direction)
+def _alarmHistory(points=()):
+	return AlarmHistory(points, ALARM_HISTORY_MAX_POINTS, ALARM_HISTORY_MAX_SEGMENTS, ALARM_HISTORY_MAX_AGE_s)
 
-			# process point depending on alarm state
-			if alarm:
-				# point is in alarm
-				#COMPARE = 'GREATER' if direction == 'MAX' else 'LESS'
-				#Logger.debug("   ...YES! {0} is {1} THAN {2}".format(s_value[1], COMPARE, th_value))
 
-				# pull previous 60 alarm points
-				prev_alarm_points = s_class_alarms[-MAX_ALARM_POINTS:]
-				#Logger.debug("   Checking previous {0} alarm points...".format(MAX_ALARM_POINTS))
+class _Threshold():
+	''' A compiled sensor threshold and its alarm state '''
 
-				if not prev_alarm_points or not prev_alarm_points[-1]:
-					# no previous alarm points, or a new alarm segment
-					# create new record w/all sensor buffer values
-					#Logger.debug("   ...NO previous alarm point for {0}, so we'll add these points".format(classification))
-					alarms_to_add = [ [ x[0], x[1] ] for x in sensor.values if x and _isNumeric(x[0]) and _isNumeric(x[1]) ]
-					#Logger.debug("alarms to add: {0}".format(alarms_to_add))
-					s_class_alarms.extend(alarms_to_add)
+	__slots__ = ('value', 'direction', 'classification', 'clear_value', 'on_delay', 'off_delay',
+		'history', 'tick', 'state', 'ticks', 'in_alarm')
 
-				else:
-					# previous alarm points - see how far back they are in alarm or until alarm segment break
-					#Logger.debug("   Previous alarm points for {0} exist...".format(classification))
-					for i, p in enumerate(reversed(prev_alarm_points)):
-						if not p or not _checkAlarm(p[1], th_value, direction):
-							break
+	def __init__(self, value, direction, classification, hysteresis=0, on_delay=0, off_delay=ALARM_LEAD_POINTS):
+		self.value = value
+		self.direction = direction
+		self.classification = classification
 
-					if i < MAX_ALARM_POINTS:
-						#Logger.debug("   ...and fewer than {0} have been recorded, so adding current point".format(MAX_ALARM_POINTS))
-						s_class_alarms.extend([ sensor.values[0] ])
+		# out of alarm once back past the threshold by the hysteresis band
+		self.clear_value = value + hysteresis if direction == MIN else value - hysteresis
 
+		self.on_delay = on_delay
+		self.off_delay = off_delay
+
+		self.history = None
+		self.tick = None # of the last sample stepped on
+		self.state = IDLE
+		self.ticks = 0 # PENDING / CLEARING ticks
+		self.in_alarm = 0 # ACTIVE ticks since (re)entering alarm
+
+	def bind(self, s_alarms, journal):
+		''' Returns the classification alarm history from the sensor alarms
+			(adding an empty one, under the journal lock, if none exists yet).
+			The state is restored from the history whenever it isn't the
+			history the state is for (first use, or alarms reloaded or reset).
+		'''
+		history = s_alarms.get(self.classification)
+		if history is None:
+			with journal.lock:
+				history = s_alarms[self.classification] = _alarmHistory()
+
+		if history is not self.history:
+			self.history = history
+			self._restore(history.tail(max(MAX_ALARM_POINTS, self.off_delay + 1)))
+
+		return history
+
+	def _restore(self, points):
+		self.state = IDLE
+		self.ticks = self.in_alarm = 0
+
+		if not points or points[-1] is None:
+			return # no open alarm segment
+
+		for p in reversed(points):
+			if p is None:
+				break
+
+			if _isNumeric(p[1]) and not self._cleared(float(p[1])):
+				if self.ticks:
+					break
+				self.in_alarm += 1
 			else:
-				# point is NOT in alarm
-				#Logger.debug("   ...NO!")
+				if self.in_alarm:
+					break
+				self.ticks += 1
 
-				# Loop through previous 5 alarm points and see if they were in alarm
-				prev_alarm_points = s_class_alarms[-ALARM_LEAD_POINTS:]
-				if prev_alarm_points:
+		self.state = ACTIVE if self.in_alarm else CLEARING
 
-					if len(prev_alarm_points) < ALARM_LEAD_POINTS or \
-						any(_checkAlarm(p[1], th_value, direction) for p in prev_alarm_points if p):
-						#Logger.debug("Fewer than {0} previous {1} alarms or any of the last {0} were in alarm...".format(ALARM_LEAD_POINTS, classification))
+	def _cleared(self, value):
+		return value >= self.clear_value if self.direction == MIN else value <= self.clear_value
 
-						# Even though we're not in alarm condition, add the point
-						# because we haven't been out of alarm for enough points
-						s_class_alarms.extend([ sensor.values[0] ])
-					else:
-						# Close alarm segment if not already closed
-						if prev_alarm_points[-1]:
-							s_class_alarms.extend([ None ])
+	def update(self, value):
+		''' Steps the state with the current sensor value, and returns what
+			to record: _OPEN (the alarm segment), _RECORD (the point), _CLOSE
+			(the alarm segment) or None.
+		'''
+		state = self.state
 
-				# else we're not in alarm and there are no prior alarm points ... move along
+		if state == ACTIVE:
+			if not self._cleared(value):
+				self.in_alarm += 1
+				return _RECORD if self.in_alarm <= MAX_ALARM_POINTS else None
 
-	#Logger.debug("Done processing alarms:")
-	#Logger.debug("{0}".format(ch_alarms))
-	_saveAlarms(channel, ch_alarms)
+			state = self.state = CLEARING
+			self.ticks = 0
 
+		above = value < self.value if self.direction == MIN else value > self.value
 
-def _isNumeric(s):
-	try:
-		return float(s) == float(s)
-	except ValueError:
-		return False
+		if state == CLEARING:
+			if above:
+				self.state = ACTIVE
+				self.in_alarm = 1
+				return _RECORD
 
+			if self.ticks < self.off_delay:
+				self.ticks += 1
+				return _RECORD
 
-def _checkAlarm(value, threshold, d):
+			self.state = IDLE
+			return _CLOSE
+
+		# IDLE or PENDING
+		if not above:
+			self.state = IDLE
+			return None
+
+		self.ticks = self.ticks + 1 if state == PENDING else 1
+
+		if self.ticks > self.on_delay:
+			self.state = ACTIVE
+			self.in_alarm = self.ticks
+			return _OPEN
+
+		self.state = PENDING
+		return None
 
-	if not _isNumeric(value):
-		return False
 
-	d = d.upper()
-	if not d in ['MIN', 'MAX']:
+def _delay(ch_id, sId, t, key, default):
+	value = t.get(key, default)
+
+	if not isinstance(value, int) or value < 0:
+		logging.getLogger(__name__).warning("{0}.{1} threshold {2} {3} invalid - using {4}".format(ch_id, sId, t.get('classification'), key, default))
+		return default
+
+	return value
+
+
+def _compileThresholds(ch_id, ch_config):
+	''' Returns { sId: [ _Threshold, ... ] } for the channel config, compiled
+		once per config load (the config object is cached by _loadConfig).
+	'''
+	compiled = THRESHOLDS_CACHE.get(ch_id)
+	if compiled and compiled[0] is ch_config:
+		return compiled[1]
+
+	logger = logging.getLogger(__name__)
+
+	thresholds = {}
+	for s_config in ch_config.get('sensors', None) or []:
+		sId = s_config.get('id')
+		s_thresholds = []
+
+		for t in s_config.get('thresholds', []):
+			value = t.get('value', None)
+			direction = DIRECTIONS.get(str(t.get('direction', '')).upper())
+			classification = t.get('classification', None)
+
+			if direction is None or not _isNumeric(value):
+				logger.warning("{0}.{1} threshold {2} ignored (invalid value or direction)".format(ch_id, sId, classification))
+				continue
+
+			hysteresis = t.get('hysteresis', 0)
+			if not _isNumeric(hysteresis) or float(hysteresis) < 0:
+				logger.warning("{0}.{1} threshold {2} hysteresis invalid - using 0".format(ch_id, sId, classification))
+				hysteresis = 0
+
+			s_thresholds.append(_Threshold(float(value), direction, classification, float(hysteresis),
+				_delay(ch_id, sId, t, 'onDelay', 0), _delay(ch_id, sId, t, 'offDelay', ALARM_LEAD_POINTS)))
+
+		if s_thresholds:
+			thresholds[sId] = s_thresholds
+
+	THRESHOLDS_CACHE[ch_id] = (ch_config, thresholds)
+	return thresholds
+
+
+def _isNumeric(s):
+	try:
+		return float(s) == float(s)
+	except (TypeError, ValueError):
 		return False
 
-	return ((d == 'MIN' and value < threshold) or (d == 'MAX' and value > threshold))
-			
 
 def _loadAlarms(channel):
 	global ALARMS_CACHE
 
-	ch_alarms_file = os.path.join(CHDIR, channel.id + '_alarms.json')
+	journal = ALARMS_JOURNALS.get(channel.id)
+	if not journal:
+		journal = ALARMS_JOURNALS[channel.id] = AlarmJournal(channel.id)
 
 	# check for presence of "chX.alarms.reset" file
 	ch_alarms_reset = os.path.join(CHDIR, channel.id + '.alarms.reset')
 
 	logger = logging.getLogger(__name__)
 
-	if os.path.isfile(ch_alarms_reset):
-		# remove ch_alarms if it is present
-		if os.path.isfile(ch_alarms_file):
-			os.remove(ch_alarms_file)
-		
+	if _checkDue(ch_alarms_reset) and os.path.isfile(ch_alarms_reset):
+		# remove the ch alarms files
+		journal.reset()
+
 		# remove the ch reset file
 		os.remove(ch_alarms_reset)
 
@@ -229,56 +477,38 @@ def _loadAlarms(channel):
 		ALARMS_CACHE[channel.id] = {}
 		logger.info("{0} alarms reset".format(channel.id))
 
-	# read alarms from file to load cache - note that this is
-	# only done at startup.  Rest of the time, the cache
-	# supplies the alarm history.
+	# read alarms from the snapshot and journal files to load
+	# cache - note that this is only done at startup.  Rest of
+	# the time, the cache supplies the alarm history.
 	if not channel.id in ALARMS_CACHE:
-
-		#Logger.debug("Channel {0} alarms not loaded".format(channel.id))
-
-		if os.path.isfile(ch_alarms_file):
-			#Logger.debug("Channel {0} alarms file found".format(channel.id))
-			# try to load from file
-			with open(ch_alarms_file, 'r') as f:
-				ALARMS_CACHE[channel.id] = json.load(f)
-				#Logger.info("Loaded channel {0} alarms".format(channel.id))
-		else:
-			# no alarms file - just create empty holder
-			ALARMS_CACHE[channel.id] = {}
-			#Logger.debug("Channel {0} alarms initialized".format(channel.id))
+		ALARMS_CACHE[channel.id] = { sId: { classification: _alarmHistory(points) for classification, points in s_alarms.items() }
+			for sId, s_alarms in journal.load().items() }
 
 	#Logger.debug("_loadAlarms: {0}".format(ALARMS_CACHE))
 	return ALARMS_CACHE[channel.id]
 
 
 # Saves alarms to disk, but only every so often to avoid
-# file IO thrashing.  Uses a random delay time since last
-# save to try to avoid all channels saving their alarms
-# at the same time.
+# file IO thrashing (see AlarmJournal.save).  Only the new
+# points are appended to the channel journal, and channels
+# without new points are not written at all.
 def _saveAlarms(channel, alarms):
 	global ALARMS_CACHE
 
-	ch_alarms_file = os.path.join(CHDIR, channel.id + '_alarms.json')
+	ALARMS_JOURNALS[channel.id].save(alarms)
 
-	# if last saved more than 10-20 seconds ago, go ahead and save alarms to disk
-	last_saved = ALARMS_CACHE.get(channel.id + '_lastsave', 0)
+	# update global cache
+	ALARMS_CACHE[channel.id] = alarms
 
-	# TODO: we could avoid saves to file if nothing has changed with the alarms
-	# since last save, but may be more lengthy to do that than just dump to file.
-	if alarms and not last_saved or (time.time() - last_saved > randint(10, 20)):
-		# dump to file
-		with LockedOpen(ch_alarms_file, 'a') as fh:
-			with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(ch_alarms_file), delete=False) as tf:
-				json.dump(alarms, tf, indent="\t")
-				tempname = tf.name
-			os.replace(tempname, ch_alarms_file)
 
-			# update the save time
-			ALARMS_CACHE[channel.id + '_lastsave'] = time.time()
-			#Logger.debug("Saved channel {0} alarms".format(channel.id))
+def _checkDue(filename):
+	# the channel files are checked every FILES_CHECK_s only
+	now = time.time()
+	if now < FILES_CHECKED.get(filename, 0):
+		return False
 
-	# update global cache
-	ALARMS_CACHE[channel.id] = alarms
+	FILES_CHECKED[filename] = now + FILES_CHECK_s
+	return True
 
 
 def _loadConfig(channel):
@@ -287,7 +517,14 @@ def _loadConfig(channel):
 
 	# get channel configuration filename
 	config_file = os.path.join(CHDIR, channel.id + '_config.json')
-	config_file_lastmod = os.stat(config_file).st_mtime
+
+	if not _checkDue(config_file):
+		return CONFIGS_CACHE.get(channel.id)
+
+	try:
+		config_file_lastmod = os.stat(config_file).st_mtime
+	except OSError:
+		return CONFIGS_CACHE.get(channel.id) # no channel config
 
 	logger = logging.getLogger(__name__)
 
@@ -0,0 +1,168 @@
+# Virtual channel formulas
+#
+# Virtual channel sensors combine the latest values of other channels'
+# sensors.  The sensor "type" selects the formula and "sources" lists the
+# source sensors as "chX.sY":
+#
+#	PIB		phase imbalance (%) - max deviation from the average of 3+ sources
+#	SUM		sum of the sources
+#	AVG		average of the sources
+#	POWER	sum of V x I over source pairs [ V1, I1, V2, I2, ... ]
+#	MIN		smallest source value
+#	MAX		largest source value
+#
+# Sources are resolved to the sensor objects once (see resolve), and all
+# the sensors of a virtual channel are evaluated in one pass that reads
+# each source's latest value once.  Missing sources (or sources without a
+# value yet) are left out; formulas without enough values return 0.
+#
+# Virtual channels can use other virtual channels as sources, so they are
+# evaluated in dependency order (see evaluationOrder) after the physical
+# channels, and always see the current tick's source values.
+
+import logging
+
+
+def _present(values):
+	return [ v for v in values if v is not None ]
+
+def _pib(values):
+	values = _present(values)
+	if len(values) < 3:
+		return 0
+
+	# Many references for this calculation, but here we use the
+	# maximum difference from average Vrms
+	Vavg = sum(values) / len(values)
+	if Vavg == 0:
+		return 0 # avoid div by zero
+
+	Vmax = max([ abs(Vavg - v) for v in values ])
+	return 100 * (Vmax / Vavg) # Phase Imbalance as percentage
+
+def _sum(values):
+	return sum(_present(values))
+
+def _avg(values):
+	values = _present(values)
+	return sum(values) / len(values) if values else 0
+
+def _power(values):
+	return sum([ v * i for v, i in zip(values[0::2], values[1::2]) if v is not None and i is not None ])
+
+def _min(values):
+	values = _present(values)
+	return min(values) if values else 0
+
+def _max(values):
+	values = _present(values)
+	return max(values) if values else 0
+
+
+VIRTUAL_FORMULAS = {
+	'PIB': _pib,
+	'SUM': _sum,
+	'AVG': _avg,
+	'POWER': _power,
+	'MIN': _min,
+	'MAX': _max
+}
+
+
+def evaluationOrder(channels):
+	''' Returns ( [ channel ids in evaluation order ], [ ids in cycles ] ).
+		Physical channels come first, then the virtual channels (those with
+		formulas) topologically sorted by their sources.  Virtual channels
+		that depend on each other in a cycle (or on a cycle) can't be
+		ordered - they're listed last, in channels order.
+	'''
+	virtual = { chId: ch.formulas.dependencies() for chId, ch in channels.items() if isinstance(getattr(ch, 'formulas', None), VirtualFormulas) }
+
+	order = [ chId for chId in channels if chId not in virtual ]
+
+	# only other virtual channels constrain the order
+	pending = { chId: set([ d for d in deps if d in virtual ]) for chId, deps in virtual.items() }
+
+	done = set()
+	progress = True
+	while pending and progress:
+		progress = False
+
+		for chId in [ c for c in channels if c in pending ]:
+			if pending[chId] <= done:
+				order.append(chId)
+				done.add(chId)
+				del pending[chId]
+				progress = True
+
+	cycles = [ c for c in channels if c in pending ]
+	return order + cycles, cycles
+
+
+class VirtualFormulas():
+	''' The compiled sensor formulas of a virtual channel '''
+
+	def __init__(self, ch_id, sensor_configs):
+		''' sensor_configs: { sId: ( type, [ "chX.sY", ... ] ) } '''
+		self._logger = logging.getLogger(__name__)
+		self.ch_id = ch_id
+
+		# [ ( sId, formula, [ "chX.sY", ... ] ) ]
+		self._configs = []
+
+		for sId, (s_type, sources) in sensor_configs.items():
+			formula = VIRTUAL_FORMULAS.get(s_type)
+
+			if not formula:
+				self._logger.error("Unknown virtual channel type: {0}".format(s_type))
+				formula = lambda values: 0
+
+			self._configs.append((sId, formula, list(sources)))
+
+		self.sources = []
+		self._formulas = []
+
+	def dependencies(self):
+		''' Ids of the channels the formulas read from '''
+		return set([ src.split('.')[0] for sId, formula, sources in self._configs for src in sources ])
+
+	def resolve(self, channels):
+		''' Resolves the "chX.sY" sources to the sensors in channels.  Call
+			again whenever the channels are set up (or reloaded).
+		'''
+		self.sources = [] # source sensors (each once)
+		index = {} # source position by "chX.sY"
+		self._formulas = []
+
+		for sId, formula, sources in self._configs:
+			positions = []
+
+			for src in sources:
+				if src not in index:
+					chId, _, srcId = src.partition('.')
+					ch = channels.get(chId)
+					sensor = ch.sensors.get(srcId) if ch else None
+
+					if sensor is None:
+						self._logger.error("{0}.{1} source {2} not found".format(self.ch_id, sId, src))
+
+					index[src] = len(self.sources)
+					self.sources.append(sensor)
+
+				positions.append(index[src])
+
+			self._formulas.append((sId, formula, positions))
+
+	def evaluate(self, sIds=None):
+		''' Returns { sId: value } for the sensors (or only those in sIds) '''
+		current = []
+		for sensor in self.sources:
+			latest = sensor.values.latest() if sensor else None
+			current.append(latest[1] if latest else None)
+
+		results = {}
+		for sId, formula, positions in self._formulas:
+			if sIds is None or sId in sIds:
+				results[sId] = formula([ current[p] for p in positions ])
+
+		return results
@@ -0,0 +1,65 @@
+# Alarm waveform storage format
+#
+# Alarm waveforms are stored as one blob per channel sensor: a small
+# header followed by the samples packed as little-endian float32,
+# optionally zlib-compressed.  Samples are stored divided by the scale
+# in the header and multiplied back when unpacked.
+
+import sys, struct, zlib
+
+from array import array
+
+WAVEFORM_MAGIC = b'CMEW'
+WAVEFORM_VERSION = 1
+
+# header flags
+WAVEFORM_ZLIB = 0x01
+
+# magic, version, flags, (reserved), step_ms, scale, sample count
+WAVEFORM_HEADER = struct.Struct('<4sBBHdfI')
+
+
+def packWaveform(samples, step_ms, scale=1.0, compress=True):
+	''' Returns the waveform blob for a list of samples
+	'''
+	if scale != 1.0:
+		samples = [ v / scale for v in samples ]
+
+	values = array('f', samples)
+	if sys.byteorder == 'big':
+		values.byteswap()
+
+	payload = values.tobytes()
+	flags = 0
+
+	if compress:
+		# only keep the compressed payload if it's actually smaller
+		compressed = zlib.compress(payload, 1)
+		if len(compressed) < len(payload):
+			payload = compressed
+			flags |= WAVEFORM_ZLIB
+
+	return WAVEFORM_HEADER.pack(WAVEFORM_MAGIC, WAVEFORM_VERSION, flags, 0, step_ms, scale, len(values)) + payload
+
+
+def unpackWaveform(blob):
+	''' Returns ( step_ms, [ samples ] ) from a waveform blob
+	'''
+	magic, version, flags, reserved, step_ms, scale, count = WAVEFORM_HEADER.unpack_from(blob)
+
+	if magic != WAVEFORM_MAGIC or version != WAVEFORM_VERSION:
+		raise ValueError("Unknown waveform format")
+
+	payload = bytes(blob[WAVEFORM_HEADER.size:])
+	if flags & WAVEFORM_ZLIB:
+		payload = zlib.decompress(payload)
+
+	values = array('f')
+	values.frombytes(payload[:4 * count])
+	if sys.byteorder == 'big':
+		values.byteswap()
+
+	if scale != 1.0:
+		return step_ms, [ v * scale for v in values ]
+
+	return step_ms, values.tolist()
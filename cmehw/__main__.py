@@ -6,8 +6,10 @@ from .common import Config, Logging
 
 from .Avalanche import Avalanche
 from .RRD import RRD
-from .Thresholds import ProcessAlarms
+from .Segments import SegmentStore
+from .Thresholds import ProcessAllAlarms, CloseAlarms
 from .Alarms import AlarmManager
+from .Scheduler import LoopScheduler
 
 SHUTDOWN_FLAG = False
 LOGGER = None
@@ -30,6 +32,9 @@ def main(args=None):
 
 	# Log to console/screen too
 	CONSOLE_LOGGING = '--console' in args
+
+	# Also publish to the columnar segment store
+	SEGMENTS = '--segments' in args
 	
 	global LOGGER
 	LOGGER = Logging.GetLogger('cmehw', {
@@ -58,40 +63,68 @@ def main(args=None):
 
 	rrd = RRD() # round-robin database - stores channel data
 
+	# channel data sinks (all get every channel update)
+	sinks = [ rrd ]
+
+	if SEGMENTS:
+		sinks.append(SegmentStore())
+
 	alarmManager = AlarmManager()
 
 	avalanche = Avalanche(alarmManager) # CME transducer bus initialization
 
 	#print("\n ---")
 
+	# loop periods start on fixed (absolute) deadlines - the scheduler
+	# logs overruns, jitter and the stage timings periodically
+	scheduler = LoopScheduler(Config.HARDWARE.LOOP_PERIOD_s)
+
 	while not SHUTDOWN_FLAG:
+		scheduler.wait() # until start of loop period
+
 		start_time = time.time() # start of loop
 
 		# The updateChannels() call on the avalanche object
 		# updates all channels' sensor values to the latest readings.
-		for ch in avalanche.updateChannels():
-			rrd.publish(avalanche.Channels[ch])
-			
-		#ProcessAlarms(ch) # check channel for alarms - i.e., value crossed threshold
+		channels = avalanche.updateChannels()
+
+		for stage, seconds in avalanche.timing.items():
+			scheduler.record(stage, seconds)
+
+		with scheduler.stage('publish'):
+			# a failing sink doesn't keep the others from publishing
+			for sink in sinks:
+				try:
+					sink.publishBatch(channels.values())
+
+				except Exception as e:
+					LOGGER.error("{0} publish failed: {1}".format(type(sink).__name__, e))
+
+		with scheduler.stage('thresholds'):
+			# check channels for alarms - i.e., value crossed threshold
+			# (alarm saves past the stage budget go to a background thread)
+			ProcessAllAlarms(channels.values())
 
 		# how long to finish loop?
 		process_time = time.time() - start_time
-
-		# sleep until at least LOOP_PERIOD
-		delay_time = 0
-		if process_time < Config.HARDWARE.LOOP_PERIOD_s:
-			delay_time = Config.HARDWARE.LOOP_PERIOD_s - process_time
+		scheduler.record('loop', process_time)
 
 		# debug/print channel values
 		#cc = "\n".join([ "{0}".format(ch.debugPrint()) for ch in channels ])
 		#LOGGER.debug(cc)		
 			
 		# "\x1b[K" is ANSII clear to end of line
-		#sys.stdout.write("\tHardware looping [{0:.3f} s, {1:.3f} s] {2}\x1b[K\r".format(process_time, delay_time, spinners[spinner_i])) 
+		#sys.stdout.write("\tHardware looping [{0:.3f} s] {1}\x1b[K\r".format(process_time, spinners[spinner_i])) 
 		#sys.stdout.flush()
 		spinner_i = (spinner_i + 1) % len(spinners)
 
-		time.sleep(delay_time)
+	# write out any buffered channel data and queued alarms before exiting
+	for sink in sinks:
+		sink.close()
+
+	CloseAlarms()
+
+	alarmManager.Close()
 
 
 if __name__ == "__main__":